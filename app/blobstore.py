@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+
+import dirTree
+from config import Config
+from utils import calculate_sha256, encode_manifest
+
+
+class BlobStore:
+    '''
+    content addressed firmware store, every file is stored once by its sha256 no matter how many versions contain it
+
+    <root>/blobs/<sha256[:2]>/<sha256>      file content
+    <root>/versions/<folder>/manifest.json  /file_list manifest of the version, json encoded exactly as served
+    <root>/versions/<folder>/files.json     manifest path -> sha256 of every file of the version
+
+    versions/ has one folder per version like the firmware folder, so it can be passed to the VersionIndex
+    '''
+    def __init__(self, root: str):
+        self.root = root
+        self.blobs_folder = os.path.join(root, 'blobs')
+        self.versions_folder = os.path.join(root, 'versions')
+        self._versions: dict[str, tuple[tuple[int, int], str, bytes, dict[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def blob_path(self, sha256_checksum: str) -> str:
+        return os.path.join(self.blobs_folder, sha256_checksum[:2], sha256_checksum)
+
+    def add_blob(self, file_path: str, sha256_checksum: str):
+        blob_path = self.blob_path(sha256_checksum)
+        if os.path.exists(blob_path):
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = f'{blob_path}.tmp'
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, blob_path)
+
+    def import_folder(self, local_folder: str, folder: str = None) -> str:
+        '''
+        ingests a firmware version folder, an already imported version is replaced
+        folder: name of the version, defaults to the name of local_folder
+        return: name of the version
+        '''
+        folder = folder or os.path.basename(os.path.normpath(local_folder))
+        md5_checksum, body = encode_manifest(local_folder)
+
+        files = {}
+        for entry in dirTree.walk(dirTree.Entry.from_dict(json.loads(body))):
+            if isinstance(entry, dirTree.FileEntry):
+                file_path = dirTree.local_path(local_folder, entry.path)
+                sha256_checksum = calculate_sha256(file_path)
+                self.add_blob(file_path, sha256_checksum)
+                files[entry.path] = sha256_checksum
+
+        # write the version next to its final place and rename it, so readers never see half a version
+        os.makedirs(self.versions_folder, exist_ok=True)
+        version_folder = os.path.join(self.versions_folder, folder)
+        tmp_folder = os.path.join(self.versions_folder, f'.{folder}.tmp')
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.mkdir(tmp_folder)
+        with open(os.path.join(tmp_folder, 'manifest.json'), 'wb') as f:
+            f.write(body)
+        with open(os.path.join(tmp_folder, 'files.json'), 'w') as f:
+            json.dump(files, f, separators=(',', ':'))
+        shutil.rmtree(version_folder, ignore_errors=True)
+        os.rename(tmp_folder, version_folder)
+        return folder
+
+    def _load(self, folder: str):
+        version_folder = os.path.join(self.versions_folder, folder)
+        if not folder or folder.startswith('.') or not os.path.isdir(version_folder):
+            return None
+        st = os.stat(version_folder)
+        signature = (st.st_ino, st.st_mtime_ns)
+
+        with self._lock:
+            version = self._versions.get(folder)
+        if version is not None and version[0] == signature:
+            return version
+
+        with open(os.path.join(version_folder, 'manifest.json'), 'rb') as f:
+            body = f.read()
+        with open(os.path.join(version_folder, 'files.json'), 'r') as f:
+            files = json.load(f)
+        version = (signature, json.loads(body)['md5_checksum'], body, files)
+
+        with self._lock:
+            self._versions[folder] = version
+        return version
+
+    def manifest(self, folder: str) -> tuple[str, bytes]:
+        '''
+        return: md5_checksum and json encoded manifest of a version, None if it is not in the store
+        '''
+        version = self._load(folder)
+        return (version[1], version[2]) if version else None
+
+    def file_paths(self, folder: str) -> dict[str, str]:
+        '''
+        return: manifest path -> blob of every file of a version
+        '''
+        return {path: self.blob_path(sha256_checksum) for path, sha256_checksum in self._load(folder)[3].items()}
+
+    def resolve(self, filename: str) -> tuple[str, str]:
+        '''
+        filename: {folder}/{path} as requested by /download
+        return: blob path and sha256 of the file, None if it is not in the store
+        '''
+        folder, _, path = filename.partition('/')
+        version = self._load(folder)
+        if version is None:
+            return None
+        sha256_checksum = version[3].get(dirTree.join_path('.', path))
+        if sha256_checksum is None:
+            return None
+        return self.blob_path(sha256_checksum), sha256_checksum
+
+    def file_path(self, folder: str, path: str) -> str:
+        '''
+        path: relative to the version folder
+        return: blob of one file of a version, None if the version or the file is not in the store
+        '''
+        version = self._load(folder)
+        if version is None or (sha256_checksum := version[3].get(dirTree.join_path('.', path))) is None:
+            return None
+        return self.blob_path(sha256_checksum)
+
+    def reload(self):
+        with self._lock:
+            self._versions.clear()
+
+
+blob_store = BlobStore(Config.BLOB_STORE) if Config.BLOB_STORE else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import firmware version folders into a blob store')
+    parser.add_argument('store', help='root folder of the blob store')
+    parser.add_argument('folders', nargs='+', help='firmware version folders to import')
+    args = parser.parse_args()
+
+    store = BlobStore(args.store)
+    for local_folder in args.folders:
+        print(f'imported {store.import_folder(local_folder)}')
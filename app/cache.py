@@ -0,0 +1,310 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+from metrics import metrics, timed
+from utils import calculate_sha256, compress_file, encode_bundle, encode_diff, encode_flat_manifest, encode_manifest
+from workers import SingleFlight, hash_pool, manifest_pool
+
+
+def tree_signature(local_folder: str) -> tuple[int, int, int]:
+    '''
+    one os.stat per file and folder below local_folder, no file is read
+    return: number of entries, total size and newest mtime_ns of everything below local_folder
+    '''
+    count = size = newest = 0
+    folders = [local_folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                count += 1
+                size += st.st_size
+                newest = max(newest, st.st_mtime_ns)
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+    return (count, size, newest)
+
+
+class LRUCache:
+    '''
+    least recently used cache, a miss awaits build(*args) and concurrent misses of the same key share one build
+    max_entries: max. number of entries, max_bytes: max. total sizeof() of all entries, None for no limit
+    '''
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def sizeof(value) -> int:
+        return 0
+
+    def lookup(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def store(self, key, value):
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.size -= self.sizeof(old)
+            self._entries[key] = value
+            self.size += self.sizeof(value)
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                     or (self.max_bytes is not None and self.size > self.max_bytes)):
+                self.size -= self.sizeof(self._entries.popitem(last=False)[1])
+
+    async def _get(self, key, build, *args):
+        if (value := self.lookup(key)) is None:
+            value = await self._flight.run(key, self._build, key, build, *args)
+        return value
+
+    async def _build(self, key, build, *args):
+        value = await build(*args)
+        self.store(key, value)
+        return value
+
+    def reload(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self._flight.coalesced,
+            'entries': len(self._entries),
+        }
+        if self.max_bytes is not None:
+            stats['bytes'] = self.size
+        return stats
+
+
+class ManifestCache(LRUCache):
+    '''
+    caches the serialized /file_list manifest of every firmware folder
+    an entry is rebuilt as soon as inode or mtime of the folder change (a file was added, removed or renamed),
+    files changed in place in it or in a subfolder are noticed within Config.MANIFEST_RECHECK_SECONDS
+    by the tree_signature of the folder, reload() drops all entries at once
+    entries: key -> (signature, tree_signature, time of the last tree check, md5_checksum, manifest),
+    one per firmware folder and never evicted
+    '''
+    @staticmethod
+    def signature(local_folder: str) -> tuple[int, int]:
+        st = os.stat(local_folder)
+        return (st.st_ino, st.st_mtime_ns)
+
+    async def get(self, local_folder: str) -> tuple[str, bytes]:
+        '''
+        return: md5_checksum and manifest of local_folder as json encoded bytes,
+                built in the manifest pool on a miss
+        '''
+        key = os.path.abspath(local_folder)
+        signature = self.signature(local_folder)
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == signature:
+            now = time.monotonic()
+            if now - entry[2] < Config.MANIFEST_RECHECK_SECONDS:
+                return self._hit(entry)
+            # a few hundred stats, cheap enough for the event loop once per interval
+            if tree_signature(local_folder) == entry[1]:
+                self.store(key, entry := (*entry[:2], now, *entry[3:]))
+                return self._hit(entry)
+
+        with self._lock:
+            self.misses += 1
+        return await self._flight.run((key, signature), self._build, key, signature, local_folder)
+
+    def _hit(self, entry) -> tuple[str, bytes]:
+        with self._lock:
+            self.hits += 1
+        return entry[3], entry[4]
+
+    async def _build(self, key: str, signature: tuple[int, int], local_folder: str) -> tuple[str, bytes]:
+        # taken before the build, so a file changed during the build is noticed by the next check
+        tree = await manifest_pool.run(tree_signature, local_folder)
+        checked = time.monotonic()
+        seconds, (md5_checksum, body) = await manifest_pool.run(timed, encode_manifest, local_folder)
+        metrics.observe_hash('md5', seconds)
+
+        self.store(key, (signature, tree, checked, md5_checksum, body))
+        return md5_checksum, body
+
+
+class DigestCache(LRUCache):
+    '''
+    caches sha256 digests of firmware files keyed by (path, size, mtime_ns)
+    the least recently used entries are dropped once max_entries is exceeded
+    path: optional sidecar json file the cache is loaded from and saved to
+    '''
+    VERSION = 1
+
+    def __init__(self, max_entries: int, path: str = None):
+        super().__init__(max_entries=max_entries)
+        self.path = path
+
+    @staticmethod
+    def key(file_path: str) -> tuple[str, int, int]:
+        st = os.stat(file_path)
+        return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+
+    async def get(self, file_path: str, key: tuple[str, int, int] = None) -> str:
+        '''
+        key: DigestCache.key(file_path) if the caller already has it
+        return: sha256 of file_path, hashed in the hash pool on a miss
+        '''
+        return await self._get(key or self.key(file_path), self._hash, file_path)
+
+    async def _hash(self, file_path: str) -> str:
+        seconds, digest = await hash_pool.run(timed, calculate_sha256, file_path)
+        metrics.observe_hash('sha256', seconds)
+        return digest
+
+    def warm_up(self, folder: str) -> int:
+        '''
+        hashes every file below folder that is not cached yet
+        return: number of hashed files
+        '''
+        hashed = 0
+        for root, dirs, files in os.walk(folder):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                key = self.key(file_path)
+                if self.lookup(key) is None:
+                    seconds, digest = timed(calculate_sha256, file_path)
+                    metrics.observe_hash('sha256', seconds)
+                    self.store(key, digest)
+                    hashed += 1
+        return hashed
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != self.VERSION:
+            return
+        with self._lock:
+            for path, size, mtime_ns, digest in data['entries'][-self.max_entries:]:
+                self._entries[(path, size, mtime_ns)] = digest
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = [[*key, digest] for key, digest in self._entries.items()]
+        # every worker process saves on shutdown, so each writes its own temp file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+class FlatManifestCache(LRUCache):
+    '''
+    caches manifests converted to the flat form keyed by their md5_checksum
+    the least recently used manifests are dropped once max_entries is exceeded
+    '''
+    def __init__(self, max_entries: int):
+        super().__init__(max_entries=max_entries)
+
+    async def get(self, manifest: tuple[str, bytes]) -> bytes:
+        '''
+        manifest: md5_checksum and json encoded manifest as returned by ManifestCache.get
+        return: flat manifest as json encoded bytes
+        '''
+        md5_checksum, body = manifest
+        return await self._get(md5_checksum, manifest_pool.run, encode_flat_manifest, body)
+
+
+class DiffCache(LRUCache):
+    '''
+    caches the serialized /diff result of version pairs keyed by the md5_checksum of both manifests,
+    so a changed folder automatically yields a new entry
+    the least recently used pairs are dropped once max_entries is exceeded
+    '''
+    def __init__(self, max_entries: int):
+        super().__init__(max_entries=max_entries)
+
+    async def get(self, from_manifest: tuple[str, bytes], to_manifest: tuple[str, bytes],
+                  ignore_file: str = None) -> tuple[str, bytes]:
+        '''
+        from_manifest, to_manifest: md5_checksum and json encoded manifest as returned by ManifestCache.get
+        ignore_file: ignore file of to_manifest, its content is part of to_md5 and so of the key
+        return: etag and diff of both manifests as json encoded bytes
+        '''
+        from_md5, from_body = from_manifest
+        to_md5, to_body = to_manifest
+        body = await self._get((from_md5, to_md5), manifest_pool.run, encode_diff, from_body, to_body, ignore_file)
+        return f'"{from_md5}-{to_md5}"', body
+
+
+class BundleCache(LRUCache):
+    '''
+    caches the /bundle container of version pairs keyed by the etag of their diff
+    the least recently used containers are dropped once their total size exceeds max_bytes
+    '''
+    def __init__(self, max_bytes: int):
+        super().__init__(max_bytes=max_bytes)
+
+    @staticmethod
+    def sizeof(body: bytes) -> int:
+        return len(body)
+
+    async def get(self, from_manifest: tuple[str, bytes], to_manifest: tuple[str, bytes],
+                  local_folder: str = None, file_paths: dict[str, str] = None,
+                  ignore_file: str = None) -> tuple[str, bytes]:
+        '''
+        local_folder, file_paths: where the files of to_manifest are read from, see utils.encode_bundle
+        ignore_file: see DiffCache.get, ignored files are not part of the container
+        return: etag and container of all files that changed from from_manifest to to_manifest
+        '''
+        etag, diff_body = await diff_cache.get(from_manifest, to_manifest, ignore_file)
+        return etag, await self._get(etag, manifest_pool.run, encode_bundle, diff_body, local_folder, file_paths)
+
+
+class CompressedCache(LRUCache):
+    '''
+    caches the compressed variants of firmware files keyed by (path, size, mtime_ns)
+    the least recently used files are dropped once their total size exceeds max_bytes
+    '''
+    def __init__(self, max_bytes: int):
+        super().__init__(max_bytes=max_bytes)
+
+    @staticmethod
+    def sizeof(variants: dict[str, bytes]) -> int:
+        return sum(len(body) for body in variants.values())
+
+    async def get(self, file_path: str) -> dict[str, bytes]:
+        '''
+        return: content coding -> compressed content of file_path, compressed in the hash pool on a miss
+        '''
+        return await self._get(DigestCache.key(file_path), hash_pool.run, compress_file, file_path)
+
+
+manifest_cache = ManifestCache()
+flat_manifest_cache = FlatManifestCache(Config.FLAT_MANIFEST_CACHE_SIZE)
+diff_cache = DiffCache(Config.DIFF_CACHE_SIZE)
+bundle_cache = BundleCache(Config.BUNDLE_CACHE_BYTES)
+compressed_cache = CompressedCache(Config.COMPRESSED_CACHE_BYTES)
+digest_cache = DigestCache(Config.DIGEST_CACHE_SIZE, Config.DIGEST_CACHE_FILE)
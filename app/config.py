@@ -1,2 +1,43 @@
+import os
+
+
 class Config:
+    # address and number of worker processes of the production launcher (python main.py)
+    HOST = os.getenv('HOST', '0.0.0.0')
+    PORT = int(os.getenv('PORT', 80))
+    WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY') or os.cpu_count() or 1)
+    # seconds running requests get to finish on shutdown
+    GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv('GRACEFUL_SHUTDOWN_TIMEOUT', 30))
+
     FIRMWARE_FOLDER = './firmware'
+    # optional content addressed store (see blobstore.py) that replaces FIRMWARE_FOLDER
+    BLOB_STORE = os.getenv('BLOB_STORE') or None
+
+    # where blocking hashing and tree walks run: 'thread', 'process' or 'inline' (event loop)
+    WORKER_MODE = os.getenv('WORKER_MODE', 'thread')
+    # pool sizes, sha256 of single files for /download and manifest builds for /file_list
+    HASH_WORKERS = int(os.getenv('HASH_WORKERS', 4))
+    MANIFEST_WORKERS = int(os.getenv('MANIFEST_WORKERS', 2))
+    # max. number of jobs queued or running per pool, further requests get a 503
+    WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 64))
+
+    # sha256 digests of firmware files, max. number of cached files and optional sidecar file
+    DIGEST_CACHE_SIZE = int(os.getenv('DIGEST_CACHE_SIZE', 16384))
+    DIGEST_CACHE_FILE = os.getenv('DIGEST_CACHE_FILE') or None
+    # seconds a cached /file_list manifest is served before the stats of all its files are checked again
+    MANIFEST_RECHECK_SECONDS = float(os.getenv('MANIFEST_RECHECK_SECONDS', 1))
+    # max. number of cached flat /file_list manifests
+    FLAT_MANIFEST_CACHE_SIZE = int(os.getenv('FLAT_MANIFEST_CACHE_SIZE', 64))
+    # max. number of cached /diff results (version pairs)
+    DIFF_CACHE_SIZE = int(os.getenv('DIFF_CACHE_SIZE', 256))
+    # max. size in bytes of all cached /bundle containers
+    BUNDLE_CACHE_BYTES = int(os.getenv('BUNDLE_CACHE_BYTES', 64 * 1024 * 1024))
+    # serve gzip/deflate variants of text files and the max. size in bytes of all cached variants
+    COMPRESS = os.getenv('COMPRESS', '1') == '1'
+    COMPRESSED_CACHE_BYTES = int(os.getenv('COMPRESSED_CACHE_BYTES', 64 * 1024 * 1024))
+    # max. number of firmware files /download keeps open
+    OPEN_FILES = int(os.getenv('OPEN_FILES', 256))
+    # shared secret POST /reload expects in the X-Reload-Token header, /reload is disabled without it
+    RELOAD_TOKEN = os.getenv('RELOAD_TOKEN') or None
+    # hash all firmware folders at startup
+    WARM_UP = os.getenv('WARM_UP', '1') == '1'
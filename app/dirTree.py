@@ -1,4 +1,7 @@
 import os
+import binascii
+import json
+import time
 # import depending on the platform
 if 'ESP32' in os.uname().sysname:
     import adafruit_hashlib as hashlib
@@ -8,6 +11,12 @@ else:
 
 # read files in chunks to be ram efficient
 CHUNK_SIZE = 1024
+# downloads are written to flash in chunks of this size instead of holding response.content in ram
+DOWNLOAD_CHUNK_SIZE = 4096
+# digests of the files on the device, next to the ugm2 folder which is never part of the tree
+DIGEST_CACHE_FILE = 'ugm2/digest_cache.txt'
+# files of an interrupted update that are already installed
+INSTALL_JOURNAL_FILE = 'ugm2/install_journal.txt'
 
 def join_path(path: str, *paths):
     '''
@@ -34,25 +43,144 @@ def basename(path):
     parts = path.split('/')
     return parts[-1] if parts else ''
 
-def calculate_md5(file_path):
+def dirname(path):
+    '''
+    same as os.path.dirname
+    '''
+    path = path.rstrip('/')
+    i = path.rfind('/')
+    return path[:i] if i > 0 else ('/' if i == 0 else '')
+
+def is_ignored(path: str, ignore) -> bool:
+    '''
+    return: True if path or one of its parent folders is in ignore, like FolderEntry.drop
+    '''
+    while path:
+        if path in ignore:
+            return True
+        path = dirname(path)
+    return False
+
+def makedirs(path):
+    '''
+    same as os.makedirs(path, exist_ok=True)
+    '''
+    cur = ''
+    for part in path.split('/'):
+        cur = join_path(cur, part) if cur else (part or '/')
+        if part in ('', '.'):
+            continue
+        try:
+            os.mkdir(cur)
+        except OSError:
+            pass
+
+def local_path(root, path: str):
+    '''
+    return: path on the filesystem of an entry path relative to root
+    '''
+    return join_path(root, path) if root else path
+
+def calculate_md5_digest(file_path):
     '''
     calculates the md5 hash of a file
-    return: md5 hash of: basename(file_path) + file_content
+    return: raw 16 byte md5 hash of: basename(file_path) + file_content
     '''
     md5_hash = hashlib.md5()
     md5_hash.update(basename(file_path).encode())
     with open(file_path, "rb") as firmware_file:
         while chunk := firmware_file.read(CHUNK_SIZE):
             md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+    return md5_hash.digest()
+
+def calculate_md5(file_path):
+    '''
+    return: hex md5 hash of: basename(file_path) + file_content
+    '''
+    return binascii.hexlify(calculate_md5_digest(file_path)).decode()
+
+class DigestCache:
+    '''
+    persisted file digests, a file is only hashed again when its size or mtime changed
+    the cache file has one line per file: path, size, mtime, hex md5 separated by tabs
+    save() only writes the files looked up or stored since load(), so deleted files drop out
+    '''
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.entries = {}
+        self.fresh = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.load()
+
+    def load(self):
+        self.entries = {}
+        self.fresh = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        file_path, size, mtime, md5_checksum = line.rstrip('\n').rsplit('\t', 3)
+                        self.entries[file_path] = (int(size), int(mtime), binascii.unhexlify(md5_checksum))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+
+    def digest(self, file_path):
+        '''
+        return: raw md5 digest of the file like calculate_md5_digest
+        '''
+        st = os.stat(file_path)
+        size, mtime = st[6], int(st[8])
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            self.hits += 1
+            digest = entry[2]
+        else:
+            self.misses += 1
+            digest = calculate_md5_digest(file_path)
+        self.fresh[file_path] = (size, mtime, digest)
+        return digest
+
+    def store(self, file_path, digest):
+        '''
+        records the digest of a file that was just written, so the next scan does not hash it
+        '''
+        st = os.stat(file_path)
+        self.fresh[file_path] = (st[6], int(st[8]), digest)
+        self.entries[file_path] = self.fresh[file_path]
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for file_path, (size, mtime, digest) in self.fresh.items():
+                f.write(f"{file_path}\t{size}\t{mtime}\t{binascii.hexlify(digest).decode()}\n")
+        replace_file(tmp_path, self.path)
+        self.entries = self.fresh
+        self.fresh = {}
 
 class Entry:
     '''
     abstract class for Folders and Files
+    the md5 hash is kept as 16 raw bytes (digest), md5_checksum is its hex form
     '''
-    def __init__(self, path: str, md5_checksum) -> None:
+    __slots__ = ('path', 'digest')
+
+    def __init__(self, path: str, md5_checksum=None, digest=None) -> None:
         self.path: str = path
-        self.md5_checksum: str = md5_checksum
+        self.digest: bytes = digest
+        if digest is None and md5_checksum:
+            self.digest = binascii.unhexlify(md5_checksum)
+
+    @property
+    def md5_checksum(self) -> str:
+        return binascii.hexlify(self.digest).decode() if self.digest is not None else None
+
+    @md5_checksum.setter
+    def md5_checksum(self, md5_checksum: str):
+        self.digest = binascii.unhexlify(md5_checksum) if md5_checksum is not None else None
 
     def to_dict(self):
         pass
@@ -74,10 +202,13 @@ class FileEntry(Entry):
     '''
     stores path and md5 hash of file
     '''
-    def __init__(self, path: str, md5_checksum=None) -> None:
-        if not md5_checksum:
-            md5_checksum = calculate_md5(path)
-        super().__init__(path, md5_checksum)
+    __slots__ = ()
+
+    def __init__(self, path: str, md5_checksum=None, root=None, digest=None, cache=None) -> None:
+        if not md5_checksum and digest is None:
+            file_path = local_path(root, path)
+            digest = cache.digest(file_path) if cache is not None else calculate_md5_digest(file_path)
+        super().__init__(path, md5_checksum, digest)
 
     def to_dict(self):
         return {
@@ -114,28 +245,31 @@ class FileEntry(Entry):
 class FolderEntry(Entry):
     '''
     stores path, childs[Entry], md5 hash of: basename(path) + (md5_checksum of all childs)
+    root: when given the tree is read from join_path(root, path) but all paths stay relative,
+          FolderEntry('.', root=folder) equals FolderEntry('.') inside folder without os.chdir
+    cache: DigestCache, files with unchanged size and mtime are not hashed again
     '''
-    def __init__(self, path: str, md5_checksum=None, childs=None, ignore=None) -> None:
+    __slots__ = ('childs',)
+
+    def __init__(self, path: str, md5_checksum=None, childs=None, ignore=None, root=None, digest=None, cache=None) -> None:
         self.childs: list[Entry] = childs if childs else []
-        super().__init__(path, md5_checksum)
+        super().__init__(path, md5_checksum, digest)
 
         if childs is None:
             self.childs = []
-            for name in os.listdir(path):
+            for name in os.listdir(local_path(root, path)):
                 entry_path = join_path(path, name)
                 if ignore is not None and entry_path in ignore:
                     continue
-                if os.stat(entry_path)[0] & 0x4000:  # Check if the item is a directory
-                    self.childs.append(FolderEntry(entry_path))
+                if os.stat(local_path(root, entry_path))[0] & 0x4000:  # Check if the item is a directory
+                    self.childs.append(FolderEntry(entry_path, root=root, cache=cache))
                 else:
-                    self.childs.append(FileEntry(entry_path))
+                    self.childs.append(FileEntry(entry_path, root=root, cache=cache))
             self.calc_md5_checksum()
         else:
             self.childs = childs
-            if md5_checksum is None:
+            if self.digest is None:
                 self.calc_md5_checksum()
-            else:
-                self.md5_checksum = md5_checksum
         
     def to_dict(self):
         return {
@@ -147,9 +281,10 @@ class FolderEntry(Entry):
     def calc_md5_checksum(self):
         md5_builder = hashlib.md5()
         md5_builder.update(basename(self.path).encode())
-        for child in sorted(self.childs, key=lambda x: x.md5_checksum):
-            md5_builder.update(child.md5_checksum.encode()) 
-        self.md5_checksum = md5_builder.hexdigest()
+        # raw digests sort like their hex form
+        for child in sorted(self.childs, key=lambda x: x.digest):
+            md5_builder.update(binascii.hexlify(child.digest))
+        self.digest = md5_builder.digest()
     
     def drop(self, ignore: set[str]):
         '''
@@ -202,22 +337,23 @@ class FolderEntry(Entry):
 
         childs = []
         can_be_removed = True
+        checksums, names = o.index()
         for entry in self.childs:
             if type(entry) == FileEntry:
-                if not (entry.md5_checksum in (e.md5_checksum for e in o.childs)):
+                if not (entry.digest in checksums):
                     entry.move(target_path)
                     childs.append(entry)
                 else:
                     can_be_removed = False
             elif type(entry) == FolderEntry:
-                oe = [e for e in o.childs if basename(e.path) == basename(entry.path)]
+                oe = names.get(basename(entry.path))
                 # same path, but not same hash: search recursive
-                if oe and oe[0].md5_checksum != entry.md5_checksum:
+                if oe is not None and oe.digest != entry.digest:
                     can_be_removed = False
-                    entry.move_diff(oe[0], target_path)
+                    entry.move_diff(oe, target_path)
                     childs.append(entry)
                 # no same path: insert completely
-                elif not oe:
+                elif oe is None:
                     entry.move(target_path)
                     childs.append(entry)
                 # same path same hash: nothing
@@ -238,39 +374,525 @@ class FolderEntry(Entry):
         return self.__str__()
 
     def __eq__(self, o: Entry):
-        return self.md5_checksum == o.md5_checksum
+        return self.digest == o.digest
 
     def __iter__(self):
         return iter(self.childs)
 
     def __sub__(self, o):
         childs = []
+        checksums, names = o.index()
         for entry in self.childs:
             if type(entry) == FileEntry:
-                if not (entry.md5_checksum in (e.md5_checksum for e in o.childs)):
+                if not (entry.digest in checksums):
                     childs.append(entry)
             elif type(entry) == FolderEntry:
-                oe = [e for e in o.childs if basename(e.path) == basename(entry.path)]
+                oe = names.get(basename(entry.path))
                 # same path, but not same hash: search recursive
-                if oe and oe[0].md5_checksum != entry.md5_checksum:
-                    childs.append(entry - oe[0])
+                if oe is not None and oe.digest != entry.digest:
+                    childs.append(entry - oe)
                 # no same path: insert completely
-                elif not oe:
+                elif oe is None:
                     childs.append(entry)
                 # same path same hash: nothing
         return FolderEntry(self.path, childs=childs)
 
+    def index(self):
+        '''
+        lookup tables of the direct childs, built once so __sub__ and move_diff run in linear time
+        return: set of digests of all childs, basename -> first child with that name
+        '''
+        checksums = set()
+        names = {}
+        for child in self.childs:
+            checksums.add(child.digest)
+            name = basename(child.path)
+            if name not in names:
+                names[name] = child
+        return checksums, names
+
     @staticmethod
     def from_dict(d):
         return FolderEntry(d['path'], d['md5_checksum'],[Entry.from_dict(dd) for dd in d['childs']]) 
 
-def walk(folder: FolderEntry):
-    q = [folder]
-    while q:
-        entry = q[0]
-        q = q[1:]
-        yield entry
+    def to_flat(self):
+        '''
+        the tree as parallel arrays in breadth first order without any nesting, parents come before their childs
+        names: basenames of all entries concatenated, the root keeps its path; offsets: end of every name in names
+        parents: index of the parent folder, -1 for the root; folders: '1' for a folder, '0' for a file
+        md5_checksums: hex md5_checksums of all entries concatenated
+        '''
+        names, offsets, parents, folders, digests = [], [], [], [], []
+        end = 0
+        q = [(self, -1)]
+        i = 0
+        while i < len(q):
+            entry, parent = q[i]
+            name = entry.path if parent < 0 else basename(entry.path)
+            end += len(name)
+            names.append(name)
+            offsets.append(end)
+            parents.append(parent)
+            digests.append(entry.digest)
+            if type(entry) == FolderEntry:
+                folders.append('1')
+                for child in entry.childs:
+                    q.append((child, i))
+            else:
+                folders.append('0')
+            i += 1
+
+        return {
+            'names': ''.join(names),
+            'offsets': offsets,
+            'parents': parents,
+            'folders': ''.join(folders),
+            'md5_checksums': binascii.hexlify(b''.join(digests)).decode(),
+        }
+
+    @staticmethod
+    def from_flat(d):
+        '''
+        rebuilds a tree from to_flat() without recursion
+        '''
+        names, offsets, parents, folders = d['names'], d['offsets'], d['parents'], d['folders']
+        digests = binascii.unhexlify(d['md5_checksums'])
+        entries = []
+        start = 0
+        for i in range(len(offsets)):
+            name = names[start:offsets[i]]
+            start = offsets[i]
+            parent = entries[parents[i]] if parents[i] >= 0 else None
+            path = join_path(parent.path, name) if parent is not None else name
+            digest = digests[16 * i:16 * (i + 1)]
+            if folders[i] == '1':
+                entry = FolderEntry(path, childs=[], digest=digest)
+            else:
+                entry = FileEntry(path, digest=digest)
+            if parent is not None:
+                parent.childs.append(entry)
+            entries.append(entry)
+        return entries[0]
+
+def walk(folder: FolderEntry, dfs=False, max_depth=None, relative=False):
+    '''
+    iterates over folder and all entries below it, breadth first or depth first (pre-order) if dfs
+    max_depth: entries deeper than max_depth are skipped, folder itself has depth 0
+    relative: yield (relative_path, entry), relative_path is the path below folder, '' for folder itself
+    every step is O(1), the breadth first queue is consumed by index instead of copying it
+    '''
+    q = [(folder, '', 0)]
+    head = 0
+    while head < len(q):
+        if dfs:
+            entry, path, depth = q.pop()
+        else:
+            entry, path, depth = q[head]
+            head += 1
+            # drop the consumed part once it is the larger half, amortized O(1)
+            if head > 32 and head * 2 > len(q):
+                del q[:head]
+                head = 0
+
+        yield (path, entry) if relative else entry
+
+        if type(entry) == FolderEntry and (max_depth is None or depth < max_depth):
+            childs = reversed(entry.childs) if dfs else entry.childs
+            for child in childs:
+                if relative:
+                    name = basename(child.path)
+                    q.append((child, path + '/' + name if path else name, depth + 1))
+                else:
+                    q.append((child, '', depth + 1))
+
+
+class InstallJournal:
+    '''
+    progress log of an update, a restarted update skips the files that were already installed
+    the first line is the md5_checksum of the new tree, the journal of another update is ignored
+    every installed file appends one line: path and hex md5 separated by a tab
+    '''
+    def __init__(self, path, version) -> None:
+        self.path = path
+        self.version = version
+        self.done = {}
+        self.started = False
+        try:
+            with open(path, 'r') as f:
+                if f.readline().rstrip('\n') != version:
+                    return
+                self.started = True
+                for line in f:
+                    try:
+                        entry_path, md5_checksum = line.rstrip('\n').rsplit('\t', 1)
+                        self.done[entry_path] = binascii.unhexlify(md5_checksum)
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+
+    def is_done(self, entry, root=None):
+        '''
+        return: True if the file was installed and its content still matches
+        '''
+        if self.done.get(entry.path) != entry.digest:
+            return False
+        try:
+            if calculate_md5_digest(local_path(root, entry.path)) == entry.digest:
+                return True
+        except OSError:
+            pass
+        del self.done[entry.path]
+        return False
+
+    def record(self, entry):
+        mode = 'a' if self.started else 'w'
+        with open(self.path, mode) as f:
+            if not self.started:
+                f.write(self.version + '\n')
+            f.write(f"{entry.path}\t{entry.md5_checksum}\n")
+        self.started = True
+        self.done[entry.path] = entry.digest
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.done = {}
+        self.started = False
+
+def replace_file(tmp_path, file_path):
+    '''
+    renames tmp_path to file_path, rename does not replace an existing file on the device
+    '''
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+    os.rename(tmp_path, file_path)
+
+def write_verified(chunks, file_path, digest=None):
+    '''
+    writes chunks to <file_path>.tmp while hashing them and only renames it once the md5 matches
+    digest: raw md5 of basename(file_path) + content like calculate_md5_digest, None skips the check
+    raises ValueError on a mismatch, file_path is left untouched
+    '''
+    tmp_path = file_path + '.tmp'
+    md5_hash = hashlib.md5()
+    md5_hash.update(basename(file_path).encode())
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                md5_hash.update(chunk)
+                f.write(chunk)
+    except Exception:
+        # interrupted transfer, do not leave the partial file behind
+        os.remove(tmp_path)
+        raise
+    if digest is not None and md5_hash.digest() != digest:
+        os.remove(tmp_path)
+        raise ValueError(f'md5_checksum mismatch: {file_path}')
+    replace_file(tmp_path, file_path)
+
+def stream_download(session, url, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    '''
+    yields the body of a GET request in chunks of chunk_size, the response is closed afterwards
+    session: adafruit_requests.Session or any session with the same interface
+    raises OSError if the status code is not 200
+    '''
+    response = session.get(url, stream=True)
+    try:
+        if response.status_code != 200:
+            raise OSError(f'download failed: {response.status_code} {url}')
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
+def download_file(session, url, file_path, digest=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    '''
+    streams url to <file_path>.tmp and renames it on success, see write_verified
+    '''
+    write_verified(stream_download(session, url, chunk_size), file_path, digest)
+
+class Downloader:
+    '''
+    fetch for install_tree that streams every file of a version from /download of the server
+    all files go through one session, adafruit_requests returns the socket of a completely read response
+    to the session and reuses it for the next request, so an install costs one connection and one tls handshake
+    timings: (path, bytes, seconds) of every downloaded file
+    '''
+    def __init__(self, session, server, folder, chunk_size=DOWNLOAD_CHUNK_SIZE) -> None:
+        self.session = session
+        self.server = server
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.timings = []
+
+    def url(self, entry):
+        return f'{self.server}/download?filename={join_path(self.folder, entry.path)}'
+
+    def __call__(self, entry):
+        start = time.monotonic()
+        size = 0
+        for chunk in stream_download(self.session, self.url(entry), self.chunk_size):
+            size += len(chunk)
+            yield chunk
+        self.timings.append((entry.path, size, time.monotonic() - start))
+
+    def total(self):
+        '''
+        return: number of files, bytes and seconds of all downloads
+        '''
+        return len(self.timings), sum(t[1] for t in self.timings), sum(t[2] for t in self.timings)
+
+def install_tree(update_tree, fetch, journal=None, root=None, retries=2):
+    '''
+    creates the folders and writes the files of update_tree below root
+    fetch: fetch(entry) returns the content of a FileEntry as bytes or an iterable of chunks,
+           e.g. the body of its /download
+    journal: InstallJournal, files it already has are verified and skipped, installed files are recorded
+    retries: a file that fails or does not match its md5_checksum is fetched again up to retries times
+    return: number of fetched files
+    '''
+    fetched = 0
+    for entry in walk(update_tree):
+        if entry.path in ('.', ''):
+            continue
+        if isinstance(entry, FolderEntry):
+            makedirs(local_path(root, entry.path))
+        elif journal is None or not journal.is_done(entry, root):
+            attempt = 0
+            while True:
+                try:
+                    content = fetch(entry)
+                    write_verified([content] if isinstance(content, bytes) else content,
+                                   local_path(root, entry.path), entry.digest)
+                    break
+                except (OSError, ValueError):
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+            fetched += 1
+            if journal is not None:
+                journal.record(entry)
+    return fetched
+
+def unpack_bundle(chunks, root=None, ignore=None):
+    '''
+    writes all files of a /bundle container below root
+    chunks: iterable of bytes, e.g. response.iter_content(CHUNK_SIZE)
+    ignore: paths that are kept on the device together with everything below them, their files are read past
+    every file is written with write_verified, so it is only renamed once its md5_checksum matches
+    raises ValueError on a truncated container or a checksum mismatch, no <path>.tmp is left behind
+    return: list[FileEntry] of the written files
+    '''
+    chunks = iter(chunks)
+    buffer = b''
+    entries = []
+
+    def read_more():
+        try:
+            return next(chunks)
+        except StopIteration:
+            raise ValueError('truncated bundle')
+
+    def framed(length):
+        # the next length bytes of the container, the rest stays in buffer for the next header
+        nonlocal buffer
+        while length:
+            if not buffer:
+                buffer = read_more()
+            part = buffer[:length]
+            buffer = buffer[length:]
+            length -= len(part)
+            yield part
+
+    while True:
+        while b'\n' not in buffer:
+            buffer += read_more()
+        line, buffer = buffer.split(b'\n', 1)
+        # empty line: end of container
+        if not line:
+            return entries
+
+        length, md5_checksum, path = line.decode().split(' ', 2)
+        if ignore is not None and is_ignored(path, ignore):
+            for _ in framed(int(length)):
+                pass
+            continue
+
+        file_path = local_path(root, path)
+        makedirs(dirname(file_path))
+        write_verified(framed(int(length)), file_path, binascii.unhexlify(md5_checksum))
+        entries.append(FileEntry(path, md5_checksum))
+
+# json bytes the manifest tokenizer skips or emits as single tokens
+_JSON_SKIP = (0x20, 0x09, 0x0a, 0x0d, 0x3a, 0x2c)  # whitespace : ,
+_JSON_BRACKETS = (0x7b, 0x7d, 0x5b, 0x5d)  # { } [ ]
+_JSON_QUOTE = 0x22
+_JSON_BACKSLASH = 0x5c
 
-        if type(entry) == FolderEntry:
-            for child in entry:
-                q.append(child)
+def _json_tokens(chunks):
+    '''
+    minimal json tokenizer over an iterable of bytes, only the current chunk and token are held in ram
+    yields (token, value): '{', '}', '[', ']' with value None, 's' with a decoded string,
+                           'v' with any other scalar (number, true, false, null) as str
+    '''
+    chunks = iter(chunks)
+    buf = b''
+    i = 0
+    while True:
+        if i >= len(buf):
+            try:
+                buf = next(chunks)
+            except StopIteration:
+                return
+            i = 0
+            continue
+
+        c = buf[i]
+        if c in _JSON_SKIP:
+            i += 1
+        elif c in _JSON_BRACKETS:
+            yield chr(c), None
+            i += 1
+        elif c == _JSON_QUOTE:
+            raw = b''
+            i += 1
+            while True:
+                j = buf.find(b'"', i)
+                if j < 0:
+                    raw += buf[i:]
+                    try:
+                        buf = next(chunks)
+                    except StopIteration:
+                        raise ValueError('truncated json string')
+                    i = 0
+                    continue
+                raw += buf[i:j]
+                i = j + 1
+                # a quote preceded by an odd number of backslashes is part of the string
+                n = 0
+                while n < len(raw) and raw[len(raw) - 1 - n] == _JSON_BACKSLASH:
+                    n += 1
+                if n % 2:
+                    raw += b'"'
+                    continue
+                break
+            yield 's', (json.loads((b'"' + raw + b'"').decode()) if b'\\' in raw else raw.decode())
+        else:
+            raw = b''
+            while True:
+                j = i
+                while j < len(buf) and buf[j] not in _JSON_SKIP and buf[j] not in _JSON_BRACKETS:
+                    j += 1
+                raw += buf[i:j]
+                i = j
+                if i < len(buf):
+                    break
+                try:
+                    buf = next(chunks)
+                except StopIteration:
+                    break
+                i = 0
+            yield 'v', raw.decode()
+
+def iter_manifest(chunks):
+    '''
+    streams a /file_list manifest without holding it in ram, memory is bounded by the depth of the tree
+    chunks: iterable of bytes, e.g. response.iter_content(CHUNK_SIZE)
+    yields (event, path, md5_checksum) in document order:
+        ('enter', path, None) when a folder starts, ('file', path, md5_checksum) for every file,
+        ('leave', path, md5_checksum) when a folder ends
+    'path' has to come before 'childs' in every folder, as written by FolderEntry.to_dict
+    '''
+    # one dict per open object, True per open childs array, False per any other array
+    stack = []
+    for token, value in _json_tokens(chunks):
+        top = stack[-1] if stack else None
+        if token == '{':
+            # only the root and the elements of childs are entries, other objects are skipped
+            entry = not stack or top is True
+            stack.append({'key': None, 'path': None, 'md5_checksum': None, 'folder': False, 'entry': entry})
+        elif token == '[':
+            childs = type(top) == dict and top['entry'] and top['key'] == 'childs'
+            if childs:
+                if top['path'] is None:
+                    raise ValueError('manifest: path has to come before childs')
+                top['folder'] = True
+                yield 'enter', top['path'], None
+            stack.append(childs)
+        elif token in ('}', ']'):
+            obj = stack.pop()
+            if token == '}' and obj['entry']:
+                yield ('leave' if obj['folder'] else 'file'), obj['path'], obj['md5_checksum']
+            # the closed container was the value of a key
+            if stack and type(stack[-1]) == dict:
+                stack[-1]['key'] = None
+        elif type(top) == dict:
+            if token == 's' and top['key'] is None:
+                top['key'] = value
+            else:
+                if top['key'] in ('path', 'md5_checksum'):
+                    top[top['key']] = value
+                top['key'] = None
+
+def parse_manifest(chunks):
+    '''
+    builds the tree of a /file_list manifest while it is streamed, same result as Entry.from_dict(json.loads(text))
+    return: FolderEntry
+    '''
+    stack = []
+    for event, path, md5_checksum in iter_manifest(chunks):
+        if event == 'enter':
+            stack.append([])
+        elif event == 'file':
+            stack[-1].append(FileEntry(path, md5_checksum))
+        else:
+            folder = FolderEntry(path, md5_checksum, stack.pop())
+            if not stack:
+                return folder
+            stack[-1].append(folder)
+    raise ValueError('truncated manifest')
+
+def diff_manifest(chunks, cur_tree, ignore=None):
+    '''
+    streams a /file_list manifest and yields what new_tree - cur_tree (FolderEntry.__sub__) contains,
+    without building new_tree, memory is bounded by the depth of the tree
+    ignore: paths of the manifest that are skipped together with everything below them
+    yields in document order, parents before their childs:
+        FolderEntry for every folder missing in cur_tree (empty childs, md5_checksum of the empty folder)
+        FileEntry for every file that is new or changed
+    '''
+    # one (checksums, names) index of the matching folder in cur_tree per open folder,
+    # None when the folder does not exist in cur_tree, False when it is ignored
+    stack = []
+    for event, path, md5_checksum in iter_manifest(chunks):
+        if event == 'leave':
+            stack.pop()
+            continue
+
+        parent = stack[-1] if stack else None
+        skip = parent is False or (ignore is not None and path in ignore)
+
+        if event == 'enter':
+            if not stack:
+                stack.append(cur_tree.index())
+            elif skip:
+                stack.append(False)
+            elif parent is None:
+                stack.append(None)
+                yield FolderEntry(path, childs=[])
+            else:
+                oe = parent[1].get(basename(path))
+                if oe is None:
+                    stack.append(None)
+                    yield FolderEntry(path, childs=[])
+                else:
+                    stack.append(oe.index())
+        elif not skip:
+            entry = FileEntry(path, md5_checksum)
+            if parent is None or entry.digest not in parent[0]:
+                yield entry
@@ -0,0 +1,149 @@
+import os
+import stat
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from urllib.parse import quote
+
+from fastapi.responses import Response
+
+from config import Config
+
+
+# max. size of one body message, larger files are sent in several parts
+SEND_CHUNK_SIZE = 1024 * 1024
+
+
+class OpenFile:
+    '''
+    an open descriptor of a firmware file, every response reads from it with os.pread
+    the descriptor keeps the inode it was opened with, a file replaced by a rename is still sent as a whole
+    key: (abspath, size, mtime_ns) like DigestCache.key
+    '''
+    __slots__ = ('path', 'key', 'stat_result', 'fd')
+
+    def __init__(self, path: str, stat_result: os.stat_result):
+        self.path = path
+        self.stat_result = stat_result
+        self.key = (os.path.abspath(path), stat_result.st_size, stat_result.st_mtime_ns)
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def __del__(self):
+        # closed when the cache dropped the file and the last response sending it is done
+        fd = getattr(self, 'fd', None)
+        if fd is not None:
+            os.close(fd)
+
+    def signature(self) -> tuple[int, int, int]:
+        return (self.stat_result.st_ino, self.stat_result.st_size, self.stat_result.st_mtime_ns)
+
+    def read(self, offset: int, size: int) -> bytes:
+        '''
+        raises OSError if the file is shorter than size bytes after offset,
+        it was truncated after the headers with its old size were built
+        '''
+        data = os.pread(self.fd, size, offset)
+        if len(data) != size:
+            raise OSError(f'{self.path} was truncated to {offset + len(data)} bytes while it was sent')
+        return data
+
+
+class OpenFileCache:
+    '''
+    keeps the most requested firmware files open, so /download does not open and close them per request
+    every lookup costs one os.stat, a file that was replaced or modified is opened again
+    the least recently used files are dropped once max_files is exceeded, a descriptor is only closed
+    when the last response that sends it is done
+    '''
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self._entries: OrderedDict[str, OpenFile] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path: str) -> OpenFile:
+        '''
+        return: the open file, None if file_path does not exist or is not a regular file
+        '''
+        try:
+            st = os.stat(file_path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        with self._lock:
+            open_file = self._entries.get(file_path)
+            if open_file is not None and open_file.signature() == (st.st_ino, st.st_size, st.st_mtime_ns):
+                self.hits += 1
+                self._entries.move_to_end(file_path)
+                return open_file
+            self.misses += 1
+
+        try:
+            open_file = OpenFile(file_path, st)
+        except OSError:
+            return None
+
+        with self._lock:
+            self._entries[file_path] = open_file
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.max_files:
+                self._entries.popitem(last=False)
+        return open_file
+
+    def reload(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+        }
+
+
+class OpenFileResponse(Response):
+    '''
+    sends an OpenFile with the headers FileResponse would send,
+    without opening the file and without a thread per read
+    every part is read with os.pread on the event loop, firmware files are small and in the page cache
+    ranges are not supported, use FileResponse for them
+    '''
+    def __init__(self, open_file: OpenFile, filename: str, headers: dict[str, str] = None,
+                 media_type: str = 'application/octet-stream'):
+        self.open_file = open_file
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        st = open_file.stat_result
+        headers = dict(headers or {})
+        headers.setdefault('content-length', str(st.st_size))
+        headers.setdefault('last-modified', formatdate(st.st_mtime, usegmt=True))
+        headers.setdefault('accept-ranges', 'bytes')
+        content_disposition_filename = quote(filename)
+        if content_disposition_filename != filename:
+            headers.setdefault('content-disposition', f"attachment; filename*=utf-8''{content_disposition_filename}")
+        else:
+            headers.setdefault('content-disposition', f'attachment; filename="{filename}"')
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        # only the size the headers announced is sent, a file that was truncated meanwhile raises
+        # and the server closes the connection, so the client sees an incomplete body
+        size = self.open_file.stat_result.st_size
+        offset = 0
+        while True:
+            end = min(offset + SEND_CHUNK_SIZE, size)
+            await send({'type': 'http.response.body', 'body': self.open_file.read(offset, end - offset),
+                        'more_body': end < size})
+            offset = end
+            if offset >= size:
+                return
+
+
+open_file_cache = OpenFileCache(Config.OPEN_FILES)
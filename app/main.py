@@ -1,8 +1,35 @@
-from fastapi import FastAPI
+import asyncio
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from blobstore import blob_store
+from cache import digest_cache
+from config import Config
+from metrics import MetricsMiddleware
 from routers import router
+from versions import version_index
+from workers import PoolFull, shutdown_pools
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    digest_cache.load()
+    versions_folder = blob_store.versions_folder if blob_store is not None else Config.FIRMWARE_FOLDER
+    if os.path.isdir(versions_folder):
+        version_index.refresh(versions_folder)
+    # the blob store knows all checksums already
+    if Config.WARM_UP and blob_store is None and os.path.isdir(Config.FIRMWARE_FOLDER):
+        await asyncio.to_thread(digest_cache.warm_up, Config.FIRMWARE_FOLDER)
+        digest_cache.save()
+    yield
+    shutdown_pools()
+    digest_cache.save()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -13,6 +40,46 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
 )
+# outermost, so the latency includes all other middlewares
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(PoolFull)
+async def pool_full_handler(request: Request, exc: PoolFull):
+    return JSONResponse(status_code=503, content={'detail': 'Server ausgelastet'}, headers={'Retry-After': '1'})
 
 # Register routers
-app.include_router(router, prefix="")
\ No newline at end of file
+app.include_router(router, prefix="")
+
+def run():
+    '''
+    production entry point, serves the app with Config.WEB_CONCURRENCY worker processes without reload
+    uvicorn picks uvloop and httptools when they are installed
+    the firmware folders are hashed once here, every worker loads the digests from the sidecar file
+    instead of hashing all files again
+    '''
+    import uvicorn
+
+    # FIRMWARE_FOLDER is relative to this file, no matter where the launcher is started from
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if Config.WARM_UP and blob_store is None and os.path.isdir(Config.FIRMWARE_FOLDER):
+        if not digest_cache.path:
+            # the workers are spawned and read Config from the environment
+            digest_cache.path = os.path.join(tempfile.gettempdir(), 'luftdaten-update-digests.json')
+            os.environ['DIGEST_CACHE_FILE'] = digest_cache.path
+        digest_cache.load()
+        digest_cache.warm_up(Config.FIRMWARE_FOLDER)
+        digest_cache.save()
+
+    uvicorn.run(
+        'main:app',
+        host=Config.HOST,
+        port=Config.PORT,
+        workers=Config.WEB_CONCURRENCY,
+        loop='auto',
+        http='auto',
+        timeout_graceful_shutdown=Config.GRACEFUL_SHUTDOWN_TIMEOUT,
+    )
+
+if __name__ == '__main__':
+    run()
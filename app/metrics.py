@@ -0,0 +1,192 @@
+import bisect
+import threading
+import time
+
+from versions import parse_version
+
+
+# upper bounds in seconds of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''
+    prometheus histogram with fixed buckets, observe() only increments preallocated counters
+    '''
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one counter per bucket plus +Inf, not cumulative, render() sums them up
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses: dict[int, int] = {}
+        self.bytes = 0
+
+
+class Metrics:
+    '''
+    counters of the server, rendered in the prometheus text format by /metrics
+    requests are only counted from the event loop, hashing is counted from worker threads too and takes a lock
+    every worker process has its own counters
+    '''
+    def __init__(self):
+        self.routes: dict[str, RouteMetrics] = {}
+        self.hash_seconds: dict[str, float] = {}
+        self.hash_count: dict[str, int] = {}
+        self.versions: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def route(self, path: str) -> RouteMetrics:
+        route = self.routes.get(path)
+        if route is None:
+            route = self.routes[path] = RouteMetrics()
+        return route
+
+    def observe_hash(self, algorithm: str, seconds: float, count: int = 1):
+        with self._lock:
+            self.hash_seconds[algorithm] = self.hash_seconds.get(algorithm, 0.0) + seconds
+            self.hash_count[algorithm] = self.hash_count.get(algorithm, 0) + count
+
+    def version_requested(self, folder: str):
+        '''
+        folder: {MODEL_ID}_{FIRMWARE_MAJOR}_{FIRMWARE_MINOR}_{FIRMWARE_PATCH}, only existing folders are counted
+        other folder names are not counted, every one of them would add a time series
+        '''
+        if parse_version(folder) is None:
+            return
+        model = folder.split('_', 1)[0]
+        versions = self.versions.get(model)
+        if versions is None:
+            versions = self.versions[model] = {}
+        versions[folder] = versions.get(folder, 0) + 1
+
+    def render(self, cache_stats: dict[str, dict[str, int]] = None) -> str:
+        lines = [
+            '# HELP update_requests_total Requests per route and status code.',
+            '# TYPE update_requests_total counter',
+        ]
+        for path, route in sorted(self.routes.items()):
+            for status, count in sorted(route.statuses.items()):
+                lines.append(f'update_requests_total{{route="{path}",status="{status}"}} {count}')
+
+        lines += [
+            '# HELP update_request_duration_seconds Request latency per route.',
+            '# TYPE update_request_duration_seconds histogram',
+        ]
+        for path, route in sorted(self.routes.items()):
+            lines += route.latency.render('update_request_duration_seconds', f'route="{path}"')
+
+        lines += [
+            '# HELP update_response_bytes_total Response body bytes sent per route.',
+            '# TYPE update_response_bytes_total counter',
+        ]
+        for path, route in sorted(self.routes.items()):
+            lines.append(f'update_response_bytes_total{{route="{path}"}} {route.bytes}')
+
+        lines += [
+            '# HELP update_hash_seconds_total Time spent hashing firmware files.',
+            '# TYPE update_hash_seconds_total counter',
+        ]
+        with self._lock:
+            hash_seconds = sorted(self.hash_seconds.items())
+            hash_count = sorted(self.hash_count.items())
+        for algorithm, seconds in hash_seconds:
+            lines.append(f'update_hash_seconds_total{{algorithm="{algorithm}"}} {seconds}')
+        lines += [
+            '# HELP update_hash_total Hashed files (sha256) and manifest builds (md5).',
+            '# TYPE update_hash_total counter',
+        ]
+        for algorithm, count in hash_count:
+            lines.append(f'update_hash_total{{algorithm="{algorithm}"}} {count}')
+
+        lines += [
+            '# HELP update_version_requests_total Requested firmware versions per model.',
+            '# TYPE update_version_requests_total counter',
+        ]
+        for model, versions in sorted(self.versions.items()):
+            for folder, count in sorted(versions.items()):
+                lines.append(f'update_version_requests_total{{model="{model}",version="{folder}"}} {count}')
+
+        for cache, stats in sorted((cache_stats or {}).items()):
+            for key, value in sorted(stats.items()):
+                lines.append(f'update_cache_{key}{{cache="{cache}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+            self.hash_seconds.clear()
+            self.hash_count.clear()
+            self.versions.clear()
+
+
+class MetricsMiddleware:
+    '''
+    asgi middleware that counts every http request by its route template, e.g. /file_list/{folder},
+    requests that match no route are counted as "other"
+    '''
+    def __init__(self, app, registry: Metrics = None):
+        self.app = app
+        self.metrics = registry if registry is not None else metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def send_counted(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            # the router stores the matched route in the scope
+            route = scope.get('route')
+            entry = self.metrics.route(getattr(route, 'path', 'other'))
+            entry.latency.observe(time.perf_counter() - start)
+            entry.statuses[status] = entry.statuses.get(status, 0) + 1
+            entry.bytes += sent
+
+
+def timed(fn, *args):
+    '''
+    runs fn(*args) in a worker, module level so process pools can pickle it
+    return: seconds fn took and its result
+    '''
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+metrics = Metrics()
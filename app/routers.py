@@ -1,57 +1,207 @@
 from fastapi import APIRouter, Request, HTTPException, Header
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response
+import hmac
 import os
 from typing import List
 
-from utils import calculate_sha256, FileEntry, get_files_with_sha256, get_folders, FolderEntry
+from utils import FileEntry, get_files_with_sha256, get_folders, etag_matches, negotiate_encoding, \
+    COMPRESSIBLE_EXTENSIONS, IGNORE_FILE_PATH
 from config import Config
-from dirTree import FolderEntry
+from cache import manifest_cache, digest_cache, diff_cache, bundle_cache, compressed_cache, flat_manifest_cache
+from versions import version_index
+from blobstore import blob_store
+from files import OpenFileResponse, open_file_cache
+from metrics import metrics
 
 
 router = APIRouter()
 
 @router.get("/download")
-async def serve_file(filename: str):
-    file_path = os.path.join(Config.FIRMWARE_FOLDER, filename)
-
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+async def serve_file(filename: str, if_none_match: str = Header(None), accept_encoding: str = Header(None),
+                     range_header: str = Header(None, alias='Range')):
+    if blob_store is not None:
+        if (blob := blob_store.resolve(filename)) is None:
+            raise HTTPException(status_code=404, detail="Datei nicht gefunden")
+        file_path, sha256_checksum = blob
+    else:
+        file_path = os.path.join(Config.FIRMWARE_FOLDER, filename)
+        # like load_manifest, "../" or an absolute filename would serve any file the server can read
+        firmware_folder = os.path.realpath(Config.FIRMWARE_FOLDER)
+        if not os.path.realpath(file_path).startswith(firmware_folder + os.sep):
+            raise HTTPException(status_code=404, detail="Datei nicht gefunden")
+
+    # a blob listed in the manifest can still be missing on disk
+    if (open_file := open_file_cache.get(file_path)) is None:
         raise HTTPException(status_code=404, detail="Datei nicht gefunden")
 
-    sha256_checksum = calculate_sha256(file_path)
-    headers = {'sha256_checksum': sha256_checksum}
-
-    return FileResponse(file_path, filename=filename, headers=headers, media_type="application/octet-stream")
+    if blob_store is None:
+        # sha256_checksum always describes the uncompressed file
+        sha256_checksum = await digest_cache.get(file_path, open_file.key)
+    headers = {'sha256_checksum': sha256_checksum, 'ETag': f'"{sha256_checksum}"', 'Vary': 'Accept-Encoding'}
+
+    # ranges refer to the uncompressed file, so they are always served as is
+    variants = {}
+    if Config.COMPRESS and range_header is None and filename.endswith(COMPRESSIBLE_EXTENSIONS) \
+            and negotiate_encoding(accept_encoding, ('gzip', 'deflate')):
+        variants = await compressed_cache.get(file_path)
+    encoding = negotiate_encoding(accept_encoding, variants)
+    if encoding:
+        headers['ETag'] = f'"{sha256_checksum}-{encoding}"'
+
+    if etag_matches(if_none_match, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return Response(content=variants[encoding], headers=headers, media_type="application/octet-stream")
+
+    # the whole file is read from the cached descriptor, no open and no stat beyond the cache lookup
+    if range_header is None:
+        return OpenFileResponse(open_file, filename, headers=headers, media_type="application/octet-stream")
+
+    # FileResponse answers Range requests with 206/416 and If-Range against the ETag above,
+    # so an interrupted download can be resumed, sha256_checksum still describes the whole file
+    return FileResponse(file_path, filename=filename, headers=headers, media_type="application/octet-stream",
+                        stat_result=open_file.stat_result)
+
+async def load_manifest(folder: str) -> tuple[str, bytes]:
+    '''
+    return: md5_checksum and json encoded manifest of a firmware folder, None if it does not exist
+    '''
+    # only direct subfolders of the firmware folder, like BlobStore._load, ".." would serve the whole app
+    if not folder or folder.startswith('.') or '/' in folder or '\\' in folder:
+        return None
+
+    if blob_store is not None:
+        return blob_store.manifest(folder)
 
-@router.get("/file_list/{folder}")
-async def serve_file_list(folder: str):
     local_folder = os.path.join(Config.FIRMWARE_FOLDER, folder)
+    if not os.path.isdir(local_folder):
+        return None
+    return await manifest_cache.get(local_folder)
+
+def ignore_file(folder: str) -> str:
+    '''
+    return: ignore file of a firmware folder on disk, the paths a device keeps when it upgrades to folder
+    '''
+    if blob_store is not None:
+        return blob_store.file_path(folder, IGNORE_FILE_PATH)
+    return os.path.join(Config.FIRMWARE_FOLDER, folder, IGNORE_FILE_PATH)
 
-    if not os.path.exists(local_folder):
+@router.get("/file_list/{folder}")
+async def serve_file_list(folder: str, flat: bool = False, if_none_match: str = Header(None)):
+    if (manifest := await load_manifest(folder)) is None:
         raise HTTPException(status_code=404, detail="Ordner nicht gefunden")        
+    metrics.version_requested(folder)
+
+    md5_checksum, body = manifest
+    headers = {'ETag': f'"{md5_checksum}-flat"' if flat else f'"{md5_checksum}"'}
+
+    if etag_matches(if_none_match, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+
+    # parallel arrays instead of nested folders, see dirTree.FolderEntry.to_flat
+    if flat:
+        body = await flat_manifest_cache.get(manifest)
+
+    return Response(content=body, headers=headers, media_type="application/json")
+
+@router.get("/diff/{from_folder}/{to_folder}")
+async def serve_diff(from_folder: str, to_folder: str, if_none_match: str = Header(None)):
+    from_manifest = await load_manifest(from_folder)
+    to_manifest = await load_manifest(to_folder)
 
-    cur_wd = os.getcwd()
-    os.chdir(local_folder)
-    folder_entry = FolderEntry('.')
-    os.chdir(cur_wd)
+    if from_manifest is None or to_manifest is None:
+        raise HTTPException(status_code=404, detail="Ordner nicht gefunden")
+    metrics.version_requested(to_folder)
 
-    return folder_entry.to_dict()
+    etag, body = await diff_cache.get(from_manifest, to_manifest, ignore_file(to_folder))
+    headers = {'ETag': etag}
+
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, headers=headers, media_type="application/json")
+
+@router.get("/bundle/{from_folder}/{to_folder}")
+async def serve_bundle(from_folder: str, to_folder: str, if_none_match: str = Header(None)):
+    from_manifest = await load_manifest(from_folder)
+    to_manifest = await load_manifest(to_folder)
+
+    if from_manifest is None or to_manifest is None:
+        raise HTTPException(status_code=404, detail="Ordner nicht gefunden")
+    metrics.version_requested(to_folder)
+
+    # shares the diff cache with /diff, so the diff has to be built with the same ignore file
+    if blob_store is not None:
+        etag, body = await bundle_cache.get(from_manifest, to_manifest, file_paths=blob_store.file_paths(to_folder),
+                                            ignore_file=ignore_file(to_folder))
+    else:
+        etag, body = await bundle_cache.get(from_manifest, to_manifest, local_folder=os.path.join(Config.FIRMWARE_FOLDER, to_folder),
+                                            ignore_file=ignore_file(to_folder))
+    headers = {'ETag': etag}
+
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, headers=headers, media_type="application/octet-stream")
 
 @router.get("/latest_version/{model_id}")
-async def get_latest_firmware_version_for_device(model_id: str):
-    path = os.path.join(Config.FIRMWARE_FOLDER)
+async def get_latest_firmware_version_for_device(model_id: str, response: Response, if_none_match: str = Header(None)):
+    path = blob_store.versions_folder if blob_store is not None else os.path.join(Config.FIRMWARE_FOLDER)
 
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail=f"Device Id: {model_id}, existiert nicht")
 
-    firmware_versions = [tuple(int(x) for x in f.split('_')) for f in os.listdir(path) if f.split('_')[0] == model_id]
+    latest_version = version_index.latest(path, model_id)
 
-    if not firmware_versions:
+    if latest_version is None:
         raise HTTPException(status_code=404, detail=f"Keine Version für Geräte mit Device Id: {model_id} gefunden")
 
-    latest_version = '_'.join([str(x) for x in max(firmware_versions)])
+    # the folder name identifies the answer, unlike the index generation it is the same in every worker
+    etag = f'"{latest_version}"'
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
 
     return latest_version
 
+@router.get("/cache_stats")
+async def get_cache_stats():
+    return cache_stats()
+
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(cache_stats()), media_type="text/plain; version=0.0.4")
+
+def cache_stats() -> dict:
+    return {
+        'manifest': manifest_cache.stats(),
+        'digest': digest_cache.stats(),
+        'flat_manifest': flat_manifest_cache.stats(),
+        'diff': diff_cache.stats(),
+        'bundle': bundle_cache.stats(),
+        'compressed': compressed_cache.stats(),
+        'open_files': open_file_cache.stats(),
+    }
+
+@router.post("/reload")
+async def reload_caches(x_reload_token: str = Header(None)):
+    # anyone could otherwise drop all caches and make every device request rehash the firmware
+    if Config.RELOAD_TOKEN is None or x_reload_token is None \
+            or not hmac.compare_digest(x_reload_token.encode(), Config.RELOAD_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Zugriff verweigert")
+    manifest_cache.reload()
+    flat_manifest_cache.reload()
+    diff_cache.reload()
+    bundle_cache.reload()
+    version_index.reload()
+    open_file_cache.reload()
+    if blob_store is not None:
+        blob_store.reload()
+    return {'manifest': manifest_cache.stats()}
+
 # TODO: could be a potential security issue
 '''
 @router.post("/sync_files")
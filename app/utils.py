@@ -1,7 +1,12 @@
 from pydantic import BaseModel
 import datetime
+import gzip
 import hashlib
+import json
 import os
+import zlib
+
+import dirTree
 
 def calculate_sha256(file_path):
     sha256_hash = hashlib.sha256()
@@ -50,3 +55,162 @@ def get_folders(folder):
             folders.append(folder_entry)
 
     return folders
+
+
+def build_manifest(local_folder):
+    '''
+    builds the /file_list manifest of a firmware folder
+    return: FolderEntry of local_folder as dict, paths relative to local_folder
+    '''
+    return dirTree.FolderEntry('.', root=local_folder).to_dict()
+
+def encode_manifest(local_folder) -> tuple[str, bytes]:
+    '''
+    return: md5_checksum of local_folder, manifest of local_folder as json encoded bytes
+    '''
+    manifest = build_manifest(local_folder)
+    return manifest['md5_checksum'], json.dumps(manifest, separators=(',', ':')).encode()
+
+def encode_flat_manifest(body: bytes) -> bytes:
+    '''
+    return: json encoded manifest converted to the flat form of FolderEntry.to_flat
+    '''
+    tree = dirTree.Entry.from_dict(json.loads(body))
+    return json.dumps(tree.to_flat(), separators=(',', ':')).encode()
+
+def manifest_files(manifest: dict) -> dict[str, str]:
+    '''
+    return: path -> md5_checksum of all files in a manifest
+    '''
+    files = {}
+    folders = [manifest]
+    while folders:
+        for child in folders.pop()['childs']:
+            if 'childs' in child:
+                folders.append(child)
+            else:
+                files[child['path']] = child['md5_checksum']
+    return files
+
+# files and folders a device keeps when it upgrades, relative to the firmware folder (see Ugm.install_update)
+IGNORE_FILE_PATH = 'ugm2/.ignore'
+
+def read_ignore(ignore_file) -> set[str]:
+    '''
+    return: manifest paths listed in an ignore file, empty if ignore_file is None or does not exist
+    '''
+    if ignore_file is None:
+        return set()
+    try:
+        with open(ignore_file, 'r') as f:
+            return set(dirTree.join_path('.', x) for x in f.read().split())
+    except OSError:
+        return set()
+
+def encode_diff(from_body: bytes, to_body: bytes, ignore_file=None) -> bytes:
+    '''
+    difference between two json encoded manifests
+    added: files only in to, changed: files in both with different md5_checksum, removed: files only in from
+    ignore_file: ignore file of to, the files below the listed paths are left out like new_tree.drop(ignore) does
+    return: diff as json encoded bytes
+    '''
+    from_manifest, to_manifest = json.loads(from_body), json.loads(to_body)
+    from_files, to_files = manifest_files(from_manifest), manifest_files(to_manifest)
+    ignore = read_ignore(ignore_file)
+    if ignore:
+        from_files = {path: md5 for path, md5 in from_files.items() if not dirTree.is_ignored(path, ignore)}
+        to_files = {path: md5 for path, md5 in to_files.items() if not dirTree.is_ignored(path, ignore)}
+
+    diff = {
+        'from_md5_checksum': from_manifest['md5_checksum'],
+        'to_md5_checksum': to_manifest['md5_checksum'],
+        'added': [],
+        'changed': [],
+        'removed': [],
+    }
+    for path in sorted(to_files):
+        if path not in from_files:
+            diff['added'].append({'path': path, 'md5_checksum': to_files[path]})
+        elif from_files[path] != to_files[path]:
+            diff['changed'].append({'path': path, 'md5_checksum': to_files[path]})
+    for path in sorted(from_files):
+        if path not in to_files:
+            diff['removed'].append({'path': path, 'md5_checksum': from_files[path]})
+
+    return json.dumps(diff, separators=(',', ':')).encode()
+
+def encode_bundle(diff_body: bytes, local_folder=None, file_paths=None) -> bytes:
+    '''
+    all added and changed files of a diff as one framed container, per file:
+    b'<length> <md5_checksum> <path>\\n' followed by <length> bytes of content,
+    the container ends with an empty line, see dirTree.unpack_bundle
+    local_folder: folder the files are read from
+    file_paths: manifest path -> file on disk, used instead of local_folder (blob store)
+    '''
+    diff = json.loads(diff_body)
+    parts = []
+    for entry in diff['added'] + diff['changed']:
+        file_path = file_paths[entry['path']] if file_paths is not None else dirTree.local_path(local_folder, entry['path'])
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        parts.append(f"{len(content)} {entry['md5_checksum']} {entry['path']}\n".encode())
+        parts.append(content)
+    parts.append(b'\n')
+    return b''.join(parts)
+
+# text files of a firmware folder that are worth compressing, .mpy and other binaries are not
+COMPRESSIBLE_EXTENSIONS = ('.py', '.toml', '.md', '.txt', '.json', '.pem', '.csv')
+# http content codings in order of preference
+CONTENT_ENCODINGS = ('gzip', 'deflate')
+# 1 KiB window, so a CircuitPython zlib decoder gets by with little ram
+DEFLATE_WBITS = 10
+
+def compress_file(file_path) -> dict[str, bytes]:
+    '''
+    return: content coding -> compressed content of file_path, only codings that are smaller than the file
+    '''
+    with open(file_path, 'rb') as f:
+        content = f.read()
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, DEFLATE_WBITS)
+    variants = {
+        'gzip': gzip.compress(content, compresslevel=9, mtime=0),
+        'deflate': compressor.compress(content) + compressor.flush(),
+    }
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(content)}
+
+def negotiate_encoding(accept_encoding, available) -> str:
+    '''
+    picks the content coding with the highest q value of an Accept-Encoding header
+    return: one of available, None for identity
+    '''
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in CONTENT_ENCODINGS:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if coding in available and q > best_q:
+            best, best_q = coding, q
+    return best
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    '''
+    weak comparison of an If-None-Match header against a quoted etag
+    '''
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
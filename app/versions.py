@@ -0,0 +1,68 @@
+import os
+import threading
+
+
+def parse_version(name: str) -> tuple[int, ...]:
+    '''
+    {MODEL_ID}_{FIRMWARE_MAJOR}_{FIRMWARE_MINOR}_{FIRMWARE_PATCH}
+    return: version as int tuple, None if name is not a version
+    '''
+    try:
+        return tuple(int(x) for x in name.split('_'))
+    except ValueError:
+        return None
+
+
+class VersionIndex:
+    '''
+    sorted firmware versions per model, built from the folder names in the firmware folder
+    the index is rebuilt when inode or mtime of the firmware folder change (a release adds a folder)
+    or after reload(), otherwise lookups do not touch the filesystem beyond a single stat
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self.versions: dict[str, list[tuple[int, ...]]] = {}
+        self._latest: dict[str, str] = {}
+        self.generation = 0
+
+    @staticmethod
+    def signature(folder: str) -> tuple[str, int, int]:
+        st = os.stat(folder)
+        return (os.path.abspath(folder), st.st_ino, st.st_mtime_ns)
+
+    def refresh(self, folder: str):
+        key = self.signature(folder)
+        versions: dict[str, list[tuple[int, ...]]] = {}
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                version = parse_version(entry.name)
+                if version is None:
+                    continue
+                versions.setdefault(entry.name.split('_')[0], []).append(version)
+        for model_versions in versions.values():
+            model_versions.sort()
+        latest = {model_id: '_'.join(str(x) for x in model_versions[-1]) for model_id, model_versions in versions.items()}
+
+        with self._lock:
+            self.versions = versions
+            self._latest = latest
+            self._key = key
+            self.generation += 1
+
+    def latest(self, folder: str, model_id: str) -> str:
+        '''
+        return: folder name of the latest version of model_id, None if there is none
+        '''
+        if self.signature(folder) != self._key:
+            self.refresh(folder)
+        return self._latest.get(model_id)
+
+    def reload(self):
+        with self._lock:
+            self._key = None
+
+
+version_index = VersionIndex()
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from config import Config
+
+
+class PoolFull(Exception):
+    pass
+
+
+class WorkerPool:
+    '''
+    runs blocking functions outside of the event loop
+    mode: 'thread', 'process' or 'inline', inline runs the function directly in the event loop
+    max_queue: max. number of submitted jobs, PoolFull is raised when exceeded
+    functions passed to a process pool have to be picklable (module level)
+    '''
+    def __init__(self, name: str, max_workers: int, max_queue: int, mode: str = 'thread'):
+        if mode not in ('thread', 'process', 'inline'):
+            raise ValueError(f'unknown worker mode: {mode}')
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.mode = mode
+        self.pending = 0
+        self._executor: Executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.mode == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+            return self._executor
+
+    def _release(self, _future):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        if self.mode == 'inline':
+            return fn(*args)
+
+        executor = self._get_executor()
+        with self._lock:
+            if self.pending >= self.max_queue:
+                raise PoolFull(self.name)
+            self.pending += 1
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    '''
+    coalesces concurrent calls with the same key into one computation, every waiter gets the same result
+    or exception, the key is released as soon as the computation finished
+    a waiter that is cancelled (e.g. client disconnected) does not cancel the computation for the others
+    '''
+    def __init__(self):
+        self._tasks: dict[object, asyncio.Task] = {}
+        self.coalesced = 0
+
+    def _release(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def run(self, key, fn, *args):
+        '''
+        fn: coroutine function, only called if no computation for key is in flight
+        '''
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._release(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+
+hash_pool = WorkerPool('hash', Config.HASH_WORKERS, Config.WORKER_QUEUE_SIZE, Config.WORKER_MODE)
+manifest_pool = WorkerPool('manifest', Config.MANIFEST_WORKERS, Config.WORKER_QUEUE_SIZE, Config.WORKER_MODE)
+
+
+def shutdown_pools():
+    hash_pool.shutdown()
+    manifest_pool.shutdown()
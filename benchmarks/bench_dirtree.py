@@ -0,0 +1,77 @@
+'''
+benchmark of the dirTree tree difference over the real firmware version pairs
+
+    python benchmarks/bench_dirtree.py [repeat]
+
+every consecutive pair of versions of a model (the path devices upgrade along) and every version
+against the latest one of its model is measured
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dirTree import FolderEntry
+from versions import parse_version
+
+FIRMWARE_FOLDER = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+
+
+def version_pairs():
+    models = {}
+    for name in os.listdir(FIRMWARE_FOLDER):
+        if (version := parse_version(name)) is not None:
+            models.setdefault(version[0], []).append((version, name))
+    pairs = set()
+    for versions in models.values():
+        names = [name for _, name in sorted(versions)]
+        pairs.update(zip(names, names[1:]))
+        pairs.update((name, names[-1]) for name in names[:-1])
+    return sorted(pairs)
+
+
+def bench_sub(trees, pairs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for cur, new in pairs:
+            trees[new] - trees[cur]
+    return time.perf_counter() - start
+
+
+def bench_move_diff(pairs):
+    elapsed = 0.0
+    for cur, new in pairs:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            device = os.path.join(temp_dir, 'device')
+            backup = os.path.join(temp_dir, 'backup')
+            shutil.copytree(os.path.join(FIRMWARE_FOLDER, cur), device)
+            os.mkdir(backup)
+            cur_tree = FolderEntry(device)
+            new_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, new))
+
+            start = time.perf_counter()
+            cur_tree.move_diff(new_tree, backup, move_self=False)
+            elapsed += time.perf_counter() - start
+        finally:
+            shutil.rmtree(temp_dir)
+    return elapsed
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    pairs = version_pairs()
+    trees = {name: FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, name)) for pair in pairs for name in pair}
+
+    sub = bench_sub(trees, pairs, repeat)
+    print(f'pairs: {len(pairs)}')
+    print(f'__sub__:   {sub / (repeat * len(pairs)) * 1e3:8.3f} ms per pair')
+    move_diff = bench_move_diff(pairs)
+    print(f'move_diff: {move_diff / len(pairs) * 1e3:8.3f} ms per pair')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+'''
+load test of the update server: a fleet of devices upgrading at the same time
+
+    python benchmarks/bench_upgrade_storm.py [--devices 200] [--concurrency 50] [--compress] [--max-p99 MS]
+
+every simulated device replays the protocol of ugm2/upgrade_mananger.py against the app in process (no network):
+poll /latest_version/{model}, fetch /file_list/{folder} of the latest version and /download every file of
+new_tree - cur_tree. the devices start on random older versions of the real app/firmware folder.
+reports req/s, p50/p99 latency per endpoint, bytes sent and cpu time per upgrade. the cpu time is the one of
+the whole process, so it contains the simulated devices as well
+--max-p99 makes the run fail (exit code 1) when an endpoint is slower or a request failed, e.g. in ci
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import httpx
+
+from config import Config
+from dirTree import Entry, FolderEntry, FileEntry, join_path, walk
+from versions import parse_version
+
+FIRMWARE_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware'))
+IGNORE_FILE_PATH = 'ugm2/.ignore'
+
+
+def read_ignore(local_folder):
+    try:
+        with open(os.path.join(local_folder, IGNORE_FILE_PATH), 'r') as f:
+            return set(f.read().split())
+    except OSError:
+        return set()
+
+
+def device_versions():
+    '''
+    return: model -> all versions but the latest one, the versions a device can upgrade from
+    '''
+    models = {}
+    for name in os.listdir(FIRMWARE_FOLDER):
+        if (version := parse_version(name)) is not None:
+            models.setdefault(version[0], []).append((version, name))
+    return {model: [name for _, name in sorted(versions)][:-1] for model, versions in models.items() if len(versions) > 1}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, endpoint, latency, response):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        # bytes on the wire, response.content is already decompressed
+        self.bytes += response.num_bytes_downloaded
+        if response.status_code != 200:
+            self.errors += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def request(client, stats, endpoint, url):
+    start = time.perf_counter()
+    response = await client.get(url)
+    stats.add(endpoint, time.perf_counter() - start, response)
+    return response
+
+
+async def upgrade(client, stats, model, cur_tree, ignore):
+    '''
+    one device, same requests in the same order as Ugm.check_if_upgrade_available and Ugm.install_update
+    return: number of downloaded files
+    '''
+    folder = (await request(client, stats, 'latest_version', f'/latest_version/{model}')).text[1:-1]
+
+    text = (await request(client, stats, 'file_list', f'/file_list/{folder}')).text
+    new_tree = Entry.from_dict(json.loads(text))
+    new_tree.drop(set(join_path(new_tree.path, x) for x in ignore))
+    update_tree = new_tree - cur_tree
+
+    downloaded = 0
+    for entry in walk(update_tree):
+        if isinstance(entry, FileEntry):
+            await request(client, stats, 'download', f'/download?filename={join_path(folder, entry.path)}')
+            downloaded += 1
+    return downloaded
+
+
+async def storm(devices, concurrency, compress, seed):
+    from main import app, lifespan
+
+    rng = random.Random(seed)
+    versions = device_versions()
+    fleet = []
+    for _ in range(devices):
+        model = rng.choice(sorted(versions))
+        fleet.append((model, rng.choice(versions[model])))
+
+    # the trees of the devices are built up front, hashing them is device work
+    trees = {}
+    for _, name in fleet:
+        if name not in trees:
+            local_folder = os.path.join(FIRMWARE_FOLDER, name)
+            ignore = read_ignore(local_folder)
+            trees[name] = (FolderEntry('.', root=local_folder, ignore=set(join_path('.', x) for x in ignore)), ignore)
+
+    stats = Stats()
+    semaphore = asyncio.Semaphore(concurrency)
+    # adafruit_requests does not ask for compressed responses
+    headers = {'Accept-Encoding': 'gzip, deflate' if compress else 'identity'}
+
+    async def device(model, name):
+        async with semaphore:
+            return await upgrade(client, stats, model, *trees[name])
+
+    Config.FIRMWARE_FOLDER = FIRMWARE_FOLDER
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://update', headers=headers) as client:
+            cpu = time.process_time()
+            start = time.perf_counter()
+            downloads = await asyncio.gather(*(device(model, name) for model, name in fleet))
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+
+    return stats, elapsed, cpu, sum(downloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='simulate a fleet of devices upgrading at the same time')
+    parser.add_argument('--devices', type=int, default=200, help='number of simulated devices')
+    parser.add_argument('--concurrency', type=int, default=50, help='devices upgrading at the same time')
+    parser.add_argument('--compress', action='store_true', help='accept gzip/deflate responses')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the versions the devices start from')
+    parser.add_argument('--max-p99', type=float, default=None, help='fail if the p99 latency of an endpoint exceeds this (ms)')
+    args = parser.parse_args()
+
+    stats, elapsed, cpu, downloads = asyncio.run(storm(args.devices, args.concurrency, args.compress, args.seed))
+
+    requests = sum(len(latencies) for latencies in stats.latencies.values())
+    print(f'devices:   {args.devices} ({args.concurrency} at a time), {downloads} files downloaded')
+    print(f'requests:  {requests} in {elapsed:.2f} s, {requests / elapsed:.0f} req/s, {stats.errors} errors')
+    for endpoint, latencies in sorted(stats.latencies.items()):
+        print(f'{endpoint:14} {len(latencies):6} requests  p50 {percentile(latencies, 0.5) * 1e3:8.2f} ms'
+              f'  p99 {percentile(latencies, 0.99) * 1e3:8.2f} ms')
+    print(f'bytes:     {stats.bytes / 1e6:.1f} MB, {stats.bytes / args.devices / 1e3:.1f} KB per upgrade')
+    print(f'cpu:       {cpu:.2f} s, {cpu / args.devices * 1e3:.1f} ms per upgrade')
+
+    if args.max_p99 is not None:
+        slow = [endpoint for endpoint, latencies in stats.latencies.items()
+                if percentile(latencies, 0.99) * 1e3 > args.max_p99]
+        if slow or stats.errors:
+            print(f'failed: {stats.errors} errors, p99 above {args.max_p99} ms: {", ".join(sorted(slow)) or "-"}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
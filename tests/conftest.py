@@ -0,0 +1,19 @@
+import pytest
+import os
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+# Import the app
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from main import app
+from config import Config
+
+
+@pytest.fixture
+def client():
+    """Create a test client for the FastAPI app, all its requests run on one event loop."""
+    # the folders of the tests are hashed on demand, not the firmware folder of the working directory
+    with patch.object(Config, 'WARM_UP', False), TestClient(app) as client:
+        yield client
@@ -0,0 +1,162 @@
+import pytest
+import os
+import tempfile
+import shutil
+import subprocess
+from unittest.mock import patch
+
+# Import the store
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from blobstore import BlobStore
+from config import Config
+
+
+FIRMWARE_FOLDER = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+VERSIONS = ["3_1_5_5", "3_1_6_0"]
+
+
+@pytest.fixture(scope="module")
+def store():
+    """Import two shipped firmware versions into a temporary store."""
+    temp_dir = tempfile.mkdtemp()
+    store = BlobStore(temp_dir)
+    for version in VERSIONS:
+        store.import_folder(os.path.join(FIRMWARE_FOLDER, version))
+    yield store
+    shutil.rmtree(temp_dir)
+
+
+def count_files(folder):
+    return sum(len(files) for _, _, files in os.walk(folder))
+
+
+class TestImport:
+    """Test cases for ingesting version folders."""
+    
+    def test_files_stored_once(self, store):
+        """Test that files shared between versions are stored only once."""
+        files = sum(count_files(os.path.join(FIRMWARE_FOLDER, version)) for version in VERSIONS)
+        blobs = count_files(store.blobs_folder)
+        
+        assert len(os.listdir(store.versions_folder)) == len(VERSIONS)
+        assert blobs < files
+    
+    def test_manifest_matches_folder(self, client, store):
+        """Test that the stored manifest equals the one built from the folder."""
+        version = VERSIONS[-1]
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', FIRMWARE_FOLDER):
+            expected = client.get(f"/file_list/{version}").content
+        
+        assert store.manifest(version)[1] == expected
+    
+    def test_reimport_replaces_version(self, store):
+        """Test that importing a version again keeps it consistent."""
+        md5_checksum = store.manifest(VERSIONS[0])[0]
+        store.import_folder(os.path.join(FIRMWARE_FOLDER, VERSIONS[0]))
+        
+        assert store.manifest(VERSIONS[0])[0] == md5_checksum
+        assert not [name for name in os.listdir(store.versions_folder) if name.startswith('.')]
+    
+    def test_resolve(self, store):
+        """Test that download file names are mapped to blobs."""
+        blob_path, sha256_checksum = store.resolve(f"{VERSIONS[-1]}/code.py")
+        
+        assert os.path.basename(blob_path) == sha256_checksum
+        assert store.resolve(f"{VERSIONS[-1]}/missing.py") is None
+        assert store.resolve("9_9_9_9/code.py") is None
+        assert store.resolve("../code.py") is None
+    
+    def test_import_tool(self):
+        """Test the command line import tool."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            result = subprocess.run(
+                [sys.executable, "blobstore.py", temp_dir, os.path.abspath(os.path.join(FIRMWARE_FOLDER, "4_1_5_3"))],
+                cwd=os.path.join(os.path.dirname(__file__), '..', 'app'), capture_output=True, text=True,
+            )
+            assert result.returncode == 0, result.stderr
+            assert "imported 4_1_5_3" in result.stdout
+            assert BlobStore(temp_dir).manifest("4_1_5_3") is not None
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestStoreEndpoints:
+    """Test cases for serving the endpoints from the store."""
+    
+    def test_download_from_store(self, client, store):
+        """Test that files are served from their blob with the stored checksum."""
+        import hashlib
+        version = VERSIONS[-1]
+        with open(os.path.join(FIRMWARE_FOLDER, version, "lib", "neopixel.mpy"), "rb") as f:
+            content = f.read()
+        
+        with patch('routers.blob_store', store):
+            response = client.get(f"/download?filename={version}/lib/neopixel.mpy")
+        
+        assert response.status_code == 200
+        assert response.content == content
+        assert response.headers["sha256_checksum"] == hashlib.sha256(content).hexdigest()
+    
+    def test_download_range_from_store(self, client, store):
+        """Test that ranges of a blob are served with the checksum of the whole file."""
+        import hashlib
+        version = VERSIONS[-1]
+        with open(os.path.join(FIRMWARE_FOLDER, version, "lib", "neopixel.mpy"), "rb") as f:
+            content = f.read()
+        
+        with patch('routers.blob_store', store):
+            response = client.get(f"/download?filename={version}/lib/neopixel.mpy", headers={"Range": "bytes=10-"})
+        
+        assert response.status_code == 206
+        assert response.content == content[10:]
+        assert response.headers["sha256_checksum"] == hashlib.sha256(content).hexdigest()
+    
+    def test_download_missing_from_store(self, client, store):
+        """Test that unknown files are not found."""
+        with patch('routers.blob_store', store):
+            response = client.get(f"/download?filename={VERSIONS[-1]}/missing.py")
+        
+        assert response.status_code == 404
+    
+    def test_download_blob_missing_on_disk(self, client, store):
+        """Test that a file whose blob was deleted from the store is not found."""
+        missing = (store.blob_path("0" * 64), "0" * 64)
+        
+        with patch('routers.blob_store', store), patch.object(store, 'resolve', return_value=missing):
+            response = client.get(f"/download?filename={VERSIONS[-1]}/lib/neopixel.mpy")
+        
+        assert response.status_code == 404
+    
+    def test_file_list_from_store(self, client, store):
+        """Test that /file_list is served from the stored manifest."""
+        with patch('routers.blob_store', store):
+            response = client.get(f"/file_list/{VERSIONS[-1]}")
+            missing = client.get("/file_list/9_9_9_9")
+        
+        assert response.status_code == 200
+        assert response.json()["md5_checksum"] == store.manifest(VERSIONS[-1])[0]
+        assert missing.status_code == 404
+    
+    def test_latest_version_from_store(self, client, store):
+        """Test that versions are listed from the store."""
+        with patch('routers.blob_store', store):
+            response = client.get("/latest_version/3")
+        
+        assert response.json() == VERSIONS[-1]
+    
+    def test_diff_and_bundle_from_store(self, client, store):
+        """Test that diffs and bundles are the same as from the folders."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', FIRMWARE_FOLDER):
+            expected_diff = client.get(f"/diff/{VERSIONS[0]}/{VERSIONS[1]}").content
+            expected_bundle = client.get(f"/bundle/{VERSIONS[0]}/{VERSIONS[1]}").content
+        
+        from cache import diff_cache, bundle_cache
+        diff_cache.reload()
+        bundle_cache.reload()
+        with patch('routers.blob_store', store):
+            assert client.get(f"/diff/{VERSIONS[0]}/{VERSIONS[1]}").content == expected_diff
+            assert client.get(f"/bundle/{VERSIONS[0]}/{VERSIONS[1]}").content == expected_bundle
@@ -0,0 +1,779 @@
+import pytest
+import os
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Import the modules under test
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+from dirTree import FolderEntry, FileEntry, Entry, DigestCache, InstallJournal, install_tree, write_verified, \
+    download_file, Downloader, unpack_bundle, calculate_md5, basename, walk, join_path, \
+    iter_manifest, parse_manifest, diff_manifest
+
+
+FIRMWARE_FOLDER = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+
+
+def build_with_chdir(folder):
+    """Build a tree the way the server used to, by changing into the folder."""
+    cur_wd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return FolderEntry('.').to_dict()
+    finally:
+        os.chdir(cur_wd)
+
+
+def legacy_sub(self, o):
+    """FolderEntry.__sub__ before the lookup index, scans o.childs for every entry."""
+    childs = []
+    for entry in self.childs:
+        if type(entry) == FileEntry:
+            if not (entry.md5_checksum in (e.md5_checksum for e in o.childs)):
+                childs.append(entry)
+        elif type(entry) == FolderEntry:
+            oe = [e for e in o.childs if basename(e.path) == basename(entry.path)]
+            if oe and oe[0].md5_checksum != entry.md5_checksum:
+                childs.append(legacy_sub(entry, oe[0]))
+            elif not oe:
+                childs.append(entry)
+    return FolderEntry(self.path, childs=childs)
+
+
+def version_pairs():
+    """All versions of a model paired with the latest one of that model."""
+    models = {}
+    for name in sorted(os.listdir(FIRMWARE_FOLDER), key=lambda x: tuple(int(v) for v in x.split('_'))):
+        models.setdefault(name.split('_')[0], []).append(name)
+    return [(name, names[-1]) for names in models.values() for name in names[:-1]]
+
+
+@pytest.fixture
+def temp_tree():
+    """Create a small nested tree for testing."""
+    temp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(temp_dir, "lib", "sub"))
+    for rel, content in [("code.py", b"print(1)"), ("lib/a.mpy", b"a"), ("lib/sub/b.mpy", b"b")]:
+        with open(os.path.join(temp_dir, rel), "wb") as f:
+            f.write(content)
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+
+class TestRelativeTree:
+    """Test cases for building trees relative to a root without os.chdir."""
+    
+    def test_root_matches_chdir(self, temp_tree):
+        """Test that root= produces the same manifest as building inside the folder."""
+        assert FolderEntry('.', root=temp_tree).to_dict() == build_with_chdir(temp_tree)
+    
+    def test_root_keeps_relative_paths(self, temp_tree):
+        """Test that entry paths do not contain the root."""
+        tree = FolderEntry('.', root=temp_tree)
+        
+        paths = sorted(child.path for child in tree.childs)
+        assert paths == ['./code.py', './lib']
+        assert FileEntry('./code.py', root=temp_tree).md5_checksum == \
+            [c for c in tree.childs if c.path == './code.py'][0].md5_checksum
+    
+    def test_root_does_not_change_cwd(self, temp_tree):
+        """Test that the working directory is never touched."""
+        cur_wd = os.getcwd()
+        FolderEntry('.', root=temp_tree)
+        assert os.getcwd() == cur_wd
+    
+    def test_real_firmware_folder(self):
+        """Test against a shipped firmware folder."""
+        folder = os.path.join(FIRMWARE_FOLDER, sorted(os.listdir(FIRMWARE_FOLDER))[-1])
+        assert FolderEntry('.', root=folder).to_dict() == build_with_chdir(folder)
+    
+    def test_concurrent_builds(self):
+        """Test that manifests of several folders can be built in parallel."""
+        folders = [os.path.join(FIRMWARE_FOLDER, f) for f in sorted(os.listdir(FIRMWARE_FOLDER))[-4:]]
+        expected = [build_with_chdir(folder) for folder in folders]
+        
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda folder: FolderEntry('.', root=folder).to_dict(), folders * 3))
+        
+        assert results == expected * 3
+
+
+class TestCompactEntries:
+    """Test cases for the __slots__ entries with raw digests and the flat manifest."""
+    
+    @pytest.fixture
+    def tree(self):
+        folder = sorted(os.listdir(FIRMWARE_FOLDER))[-1]
+        return FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, folder))
+    
+    def test_raw_digest(self, temp_tree):
+        """Test that the digest is stored raw and md5_checksum stays the hex md5 of name + content."""
+        import hashlib
+        entry = FileEntry('./code.py', root=temp_tree)
+        
+        assert entry.digest == hashlib.md5(b"code.py" + b"print(1)").digest()
+        assert entry.md5_checksum == hashlib.md5(b"code.py" + b"print(1)").hexdigest()
+        assert FileEntry.from_dict(entry.to_dict()).digest == entry.digest
+    
+    def test_slots(self, tree):
+        """Test that entries have no per instance __dict__."""
+        assert not hasattr(tree, '__dict__')
+        assert not hasattr(tree.childs[0], '__dict__')
+    
+    def test_folder_checksum_unchanged(self, temp_tree):
+        """Test that folder checksums are computed from the hex form of the child checksums."""
+        import hashlib
+        tree = FolderEntry('.', root=temp_tree)
+        
+        md5_hash = hashlib.md5(b".")
+        for child in sorted(tree.childs, key=lambda c: c.md5_checksum):
+            md5_hash.update(child.md5_checksum.encode())
+        assert tree.md5_checksum == md5_hash.hexdigest()
+    
+    def test_flat_round_trip(self, tree):
+        """Test that the flat form restores the same tree."""
+        flat = json.loads(json.dumps(tree.to_flat()))
+        
+        assert FolderEntry.from_flat(flat).to_dict() == tree.to_dict()
+        assert len(flat["offsets"]) == len(flat["parents"]) == len(flat["folders"]) == len(flat["md5_checksums"]) // 32
+    
+    def test_flat_empty_folder(self):
+        """Test that empty folders stay folders."""
+        tree = FolderEntry('.', childs=[FolderEntry('./empty', childs=[])])
+        
+        restored = FolderEntry.from_flat(tree.to_flat())
+        assert type(restored.childs[0]) == FolderEntry
+        assert restored.md5_checksum == tree.md5_checksum
+
+
+class TestTreeDifference:
+    """Test cases for the index based FolderEntry.__sub__ and move_diff."""
+    
+    @pytest.mark.parametrize("cur,new", version_pairs())
+    def test_sub_identical_to_legacy(self, cur, new):
+        """Test that the difference is byte-identical to the previous implementation."""
+        cur_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, cur))
+        new_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, new))
+        
+        assert json.dumps((new_tree - cur_tree).to_dict()) == json.dumps(legacy_sub(new_tree, cur_tree).to_dict())
+        assert json.dumps((cur_tree - new_tree).to_dict()) == json.dumps(legacy_sub(cur_tree, new_tree).to_dict())
+    
+    def test_sub_duplicate_names(self):
+        """Test that the first child with a name is used, like the previous implementation."""
+        a = FolderEntry('./a', childs=[FileEntry('./a/x', 'aa')])
+        b = FolderEntry('./a', childs=[FileEntry('./a/x', 'bb')])
+        new_tree = FolderEntry('.', childs=[FolderEntry('./a', childs=[FileEntry('./a/x', 'cc')])])
+        cur_tree = FolderEntry('.', childs=[a, b])
+        
+        assert (new_tree - cur_tree).to_dict() == legacy_sub(new_tree, cur_tree).to_dict()
+    
+    def test_move_diff(self):
+        """Test that move_diff moves exactly the files that differ."""
+        cur, new = version_pairs()[-1]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            device = os.path.join(temp_dir, "device")
+            backup = os.path.join(temp_dir, "backup")
+            shutil.copytree(os.path.join(FIRMWARE_FOLDER, cur), device)
+            os.mkdir(backup)
+            cur_tree = FolderEntry('.', root=device)
+            new_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, new))
+            expected = legacy_sub(cur_tree, new_tree)
+            
+            FolderEntry(device).move_diff(new_tree, backup, move_self=False)
+            
+            assert FolderEntry('.', root=backup).md5_checksum == FolderEntry('.', childs=expected.childs).md5_checksum
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestWalk:
+    """Test cases for walk()."""
+    
+    @pytest.fixture
+    def tree(self):
+        folder = sorted(os.listdir(FIRMWARE_FOLDER))[-1]
+        return FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, folder))
+    
+    def legacy_walk(self, folder):
+        """walk() before the index based queue."""
+        q = [folder]
+        while q:
+            entry = q[0]
+            q = q[1:]
+            yield entry
+            if type(entry) == FolderEntry:
+                for child in entry:
+                    q.append(child)
+    
+    def test_breadth_first_order_unchanged(self, tree):
+        """Test that the default order is the same as before."""
+        assert [e.path for e in walk(tree)] == [e.path for e in self.legacy_walk(tree)]
+    
+    def test_depth_first(self, tree):
+        """Test that dfs yields every entry before the ones below it, in child order."""
+        paths = [e.path for e in walk(tree, dfs=True)]
+        
+        assert sorted(paths) == sorted(e.path for e in walk(tree))
+        assert paths[0] == '.'
+        assert paths[1] == tree.childs[0].path
+        for i, path in enumerate(paths[1:], 1):
+            parent = path.rsplit('/', 1)[0]
+            assert paths.index(parent) < i
+    
+    def test_max_depth(self, tree):
+        """Test that entries below max_depth are skipped."""
+        assert [e.path for e in walk(tree, max_depth=0)] == ['.']
+        assert [e.path for e in walk(tree, max_depth=1)] == ['.'] + [c.path for c in tree.childs]
+    
+    def test_relative_paths(self, tree):
+        """Test that relative paths are the entry paths below the walked folder."""
+        pairs = list(walk(tree, relative=True))
+        
+        assert pairs[0] == ('', tree)
+        for path, entry in pairs[1:]:
+            assert './' + path == entry.path
+        lib = [e for e in tree.childs if e.path == './lib'][0]
+        assert all(entry.path == './lib/' + path for path, entry in walk(lib, dfs=True, relative=True) if path)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestStreamingManifest:
+    """Test cases for parsing and diffing a manifest while it is streamed."""
+    
+    IGNORE = ["ugm2", "settings.toml", "main.py", "boot.toml", "startup.toml", "sensors.toml"]
+    
+    def manifest(self, folder):
+        return json.dumps(FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, folder)).to_dict()).encode()
+    
+    @pytest.mark.parametrize("size", [1, 7, 1024, 1 << 20])
+    def test_parse_matches_from_dict(self, size):
+        """Test that the streamed tree equals Entry.from_dict(json.loads(text)) for any chunk size."""
+        body = self.manifest(sorted(os.listdir(FIRMWARE_FOLDER))[-1])
+        
+        assert parse_manifest(chunked(body, size)).to_dict() == Entry.from_dict(json.loads(body)).to_dict()
+    
+    def test_parse_formatting_and_escapes(self):
+        """Test whitespace, key order, escaped characters and non ascii names."""
+        tree = {
+            "md5_checksum": "00" * 16,
+            "path": ".",
+            "childs": [
+                {"md5_checksum": "11" * 16, "path": './a "quoted" \\ name'},
+                {"path": "./\u00e4", "childs": [], "md5_checksum": "22" * 16, "extra": [1, {"x": None}]},
+            ],
+        }
+        body = json.dumps(tree, indent=2, ensure_ascii=False).encode()
+        
+        parsed = parse_manifest(chunked(body, 3))
+        assert parsed.childs[0].path == './a "quoted" \\ name'
+        assert parsed.childs[1].path == "./\u00e4"
+        assert parsed.md5_checksum == "00" * 16
+    
+    def test_iter_manifest_events(self):
+        """Test the order of the events."""
+        tree = FolderEntry('.', childs=[FolderEntry('./lib', childs=[FileEntry('./lib/a', "aa" * 16)])])
+        events = list(iter_manifest([json.dumps(tree.to_dict()).encode()]))
+        
+        assert [(event, path) for event, path, _ in events] == [
+            ('enter', '.'), ('enter', './lib'), ('file', './lib/a'), ('leave', './lib'), ('leave', '.'),
+        ]
+        assert events[-1][2] == tree.md5_checksum
+    
+    def test_truncated(self):
+        """Test that a truncated manifest is rejected."""
+        body = self.manifest(sorted(os.listdir(FIRMWARE_FOLDER))[-1])
+        
+        with pytest.raises(ValueError):
+            parse_manifest(chunked(body[:len(body) // 2], 64))
+    
+    @pytest.mark.parametrize("cur,new", version_pairs())
+    def test_diff_matches_sub(self, cur, new):
+        """Test that the streamed diff yields the entries of new_tree - cur_tree, including ignored paths."""
+        cur_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, cur))
+        body = self.manifest(new)
+        new_tree = Entry.from_dict(json.loads(body))
+        ignore = set(join_path(new_tree.path, x) for x in self.IGNORE)
+        new_tree.drop(ignore)
+        update_tree = new_tree - cur_tree
+        cur_paths = set(e.path for e in walk(cur_tree))
+        
+        streamed = list(diff_manifest(chunked(body, 512), cur_tree, ignore=ignore))
+        
+        files = [e for e in walk(update_tree) if type(e) == FileEntry]
+        assert sorted((e.path, e.md5_checksum) for e in streamed if type(e) == FileEntry) == \
+            sorted((e.path, e.md5_checksum) for e in files)
+        new_folders = [e.path for e in walk(update_tree) if type(e) == FolderEntry and e.path not in cur_paths]
+        assert sorted(e.path for e in streamed if type(e) == FolderEntry) == sorted(new_folders)
+        # parents come before their childs
+        seen = set(cur_paths)
+        for entry in streamed:
+            assert entry.path.rsplit('/', 1)[0] in seen
+            seen.add(entry.path)
+
+
+class TestDigestCache:
+    """Test cases for the persisted digest cache of the device."""
+    
+    def test_same_tree(self, temp_tree, tmp_path):
+        """Test that a cached tree equals a freshly hashed one."""
+        cache = DigestCache(str(tmp_path / "digests.txt"))
+        
+        assert FolderEntry('.', root=temp_tree, cache=cache).to_dict() == FolderEntry('.', root=temp_tree).to_dict()
+        assert cache.misses == 3
+    
+    def test_reuse_after_save(self, temp_tree, tmp_path):
+        """Test that a saved cache hashes only changed files on the next scan."""
+        cache_file = str(tmp_path / "digests.txt")
+        cache = DigestCache(cache_file)
+        FolderEntry('.', root=temp_tree, cache=cache)
+        cache.save()
+        
+        cache = DigestCache(cache_file)
+        FolderEntry('.', root=temp_tree, cache=cache)
+        assert (cache.hits, cache.misses) == (3, 0)
+        
+        with open(os.path.join(temp_tree, "lib", "a.mpy"), "wb") as f:
+            f.write(b"changed")
+        cache = DigestCache(cache_file)
+        tree = FolderEntry('.', root=temp_tree, cache=cache)
+        assert (cache.hits, cache.misses) == (2, 1)
+        assert tree.to_dict() == FolderEntry('.', root=temp_tree).to_dict()
+    
+    def test_save_drops_deleted_files(self, temp_tree, tmp_path):
+        """Test that files which were not seen since load are not written again."""
+        cache_file = str(tmp_path / "digests.txt")
+        cache = DigestCache(cache_file)
+        FolderEntry('.', root=temp_tree, cache=cache)
+        cache.save()
+        
+        os.remove(os.path.join(temp_tree, "code.py"))
+        cache = DigestCache(cache_file)
+        FolderEntry('.', root=temp_tree, cache=cache)
+        cache.save()
+        
+        with open(cache_file) as f:
+            assert sorted(line.split("\t")[0] for line in f) == \
+                sorted(join_path(temp_tree, p) for p in ["lib/a.mpy", "lib/sub/b.mpy"])
+    
+    def test_store(self, temp_tree, tmp_path):
+        """Test that a stored digest is used without hashing the file."""
+        cache = DigestCache(str(tmp_path / "digests.txt"))
+        file_path = os.path.join(temp_tree, "code.py")
+        cache.store(file_path, b"\x00" * 16)
+        
+        assert cache.digest(file_path) == b"\x00" * 16
+        assert cache.misses == 0
+    
+    def test_missing_or_broken_file(self, temp_tree, tmp_path):
+        """Test that a missing or damaged cache file only costs a full scan."""
+        cache_file = tmp_path / "digests.txt"
+        assert DigestCache(str(cache_file)).entries == {}
+        
+        cache_file.write_text("garbage\n./x\t1\t2\tnothex\n")
+        cache = DigestCache(str(cache_file))
+        FolderEntry('.', root=temp_tree, cache=cache)
+        assert cache.misses == 3
+
+
+class TestResumableInstall:
+    """Test cases for installing an update with a journal."""
+    
+    @pytest.fixture
+    def update(self, tmp_path):
+        """A device with the oldest version of a model and the update to the latest one."""
+        cur, new = version_pairs()[0]
+        device = str(tmp_path / "device")
+        shutil.copytree(os.path.join(FIRMWARE_FOLDER, cur), device)
+        new_folder = os.path.join(FIRMWARE_FOLDER, new)
+        new_tree = FolderEntry('.', root=new_folder)
+        update_tree = new_tree - FolderEntry('.', root=device)
+        return device, new_folder, new_tree, update_tree, str(tmp_path / "journal.txt")
+    
+    @staticmethod
+    def fetcher(new_folder, fail_after=None):
+        fetched = []
+        
+        def fetch(entry):
+            if fail_after is not None and len(fetched) == fail_after:
+                raise OSError("connection lost")
+            fetched.append(entry.path)
+            with open(os.path.join(new_folder, entry.path), "rb") as f:
+                return f.read()
+        return fetch, fetched
+    
+    def files(self, update_tree):
+        return [e for e in walk(update_tree) if type(e) == FileEntry]
+    
+    def test_install(self, update):
+        """Test that an installed update has the files of the new tree."""
+        device, new_folder, new_tree, update_tree, journal_file = update
+        fetch, fetched = self.fetcher(new_folder)
+        
+        assert install_tree(update_tree, fetch, InstallJournal(journal_file, new_tree.md5_checksum), root=device) == \
+            len(self.files(update_tree))
+        assert self.files(new_tree - FolderEntry('.', root=device)) == []
+    
+    def test_resume(self, update):
+        """Test that a restarted update only fetches the files that were not installed yet."""
+        device, new_folder, new_tree, update_tree, journal_file = update
+        files = self.files(update_tree)
+        assert len(files) > 3
+        
+        fetch, _ = self.fetcher(new_folder, fail_after=3)
+        with pytest.raises(OSError):
+            install_tree(update_tree, fetch, InstallJournal(journal_file, new_tree.md5_checksum), root=device)
+        
+        fetch, fetched = self.fetcher(new_folder)
+        install_tree(update_tree, fetch, InstallJournal(journal_file, new_tree.md5_checksum), root=device)
+        assert fetched == [e.path for e in files[3:]]
+    
+    def test_resume_verifies_files(self, update):
+        """Test that a journaled file whose content changed is fetched again."""
+        device, new_folder, new_tree, update_tree, journal_file = update
+        first = self.files(update_tree)[0]
+        journal = InstallJournal(journal_file, new_tree.md5_checksum)
+        fetch, _ = self.fetcher(new_folder, fail_after=1)
+        with pytest.raises(OSError):
+            install_tree(update_tree, fetch, journal, root=device)
+        with open(os.path.join(device, first.path), "wb") as f:
+            f.write(b"truncated")
+        
+        fetch, fetched = self.fetcher(new_folder)
+        install_tree(update_tree, fetch, InstallJournal(journal_file, new_tree.md5_checksum), root=device)
+        assert fetched[0] == first.path
+    
+    def test_other_version_ignored(self, update):
+        """Test that the journal of another update is not used."""
+        device, new_folder, new_tree, update_tree, journal_file = update
+        fetch, _ = self.fetcher(new_folder, fail_after=2)
+        with pytest.raises(OSError):
+            install_tree(update_tree, fetch, InstallJournal(journal_file, new_tree.md5_checksum), root=device)
+        
+        assert len(InstallJournal(journal_file, new_tree.md5_checksum).done) == 2
+        assert InstallJournal(journal_file, "0" * 32).done == {}
+    
+    def test_streamed_chunks(self, update):
+        """Test that fetch may return the content in chunks."""
+        device, new_folder, new_tree, update_tree, _ = update
+        fetch, _ = self.fetcher(new_folder)
+        
+        install_tree(update_tree, lambda entry: (b for b in [fetch(entry)[:5], fetch(entry)[5:]]), root=device)
+        assert self.files(new_tree - FolderEntry('.', root=device)) == []
+    
+    def test_retry_truncated_file(self, update):
+        """Test that only the file with a truncated transfer is fetched again."""
+        device, new_folder, new_tree, update_tree, _ = update
+        fetch, fetched = self.fetcher(new_folder)
+        first = self.files(update_tree)[0]
+        broken = []
+        
+        def flaky(entry):
+            content = fetch(entry)
+            if entry.path == first.path and not broken:
+                broken.append(entry.path)
+                return content[:len(content) // 2]
+            return content
+        
+        install_tree(update_tree, flaky, root=device)
+        assert fetched.count(first.path) == 2
+        assert len(fetched) == len(self.files(update_tree)) + 1
+        assert self.files(new_tree - FolderEntry('.', root=device)) == []
+    
+    def test_mismatch_keeps_file(self, tmp_path):
+        """Test that a file whose content does not match is not replaced."""
+        file_path = str(tmp_path / "code.py")
+        with open(file_path, "wb") as f:
+            f.write(b"old")
+        
+        with pytest.raises(ValueError):
+            write_verified([b"new"], file_path, FileEntry(file_path).digest)
+        with open(file_path, "rb") as f:
+            assert f.read() == b"old"
+        assert os.listdir(tmp_path) == ["code.py"]
+    
+    def test_retries_exhausted(self, update):
+        """Test that a file that never matches raises after the retries."""
+        device, _, _, update_tree, _ = update
+        calls = []
+        
+        def corrupt(entry):
+            calls.append(entry.path)
+            return b"corrupt"
+        
+        with pytest.raises(ValueError):
+            install_tree(update_tree, corrupt, root=device, retries=2)
+        assert len(calls) == 3
+    
+    def test_clear(self, update):
+        """Test that clearing removes the journal file."""
+        _, _, new_tree, _, journal_file = update
+        journal = InstallJournal(journal_file, new_tree.md5_checksum)
+        journal.record(FileEntry('./x', "00" * 16))
+        journal.clear()
+        
+        assert not os.path.exists(journal_file)
+
+
+class FakeResponse:
+    """Minimal streamed response of adafruit_requests."""
+    
+    def __init__(self, session, status_code, content):
+        self.session = session
+        self.status_code = status_code
+        self.content = content
+    
+    def iter_content(self, chunk_size):
+        self.session.chunk_sizes.append(chunk_size)
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+    
+    def close(self):
+        self.session.closed += 1
+
+
+class FakeSession:
+    """Serves files of a folder like /download of the update server."""
+    
+    def __init__(self, folder, fail=()):
+        self.folder = folder
+        self.fail = set(fail)
+        self.urls = []
+        self.chunk_sizes = []
+        self.closed = 0
+    
+    def get(self, url, stream=False):
+        assert stream
+        self.urls.append(url)
+        filename = url.split("filename=", 1)[1]
+        if filename in self.fail:
+            self.fail.discard(filename)
+            return FakeResponse(self, 503, b"")
+        with open(os.path.join(self.folder, filename), "rb") as f:
+            return FakeResponse(self, 200, f.read())
+
+
+class TestStreamingDownload:
+    """Test cases for streaming downloads to flash."""
+    
+    def test_download_file(self, temp_tree, tmp_path):
+        """Test that a file is streamed in chunks of the given size and the response is closed."""
+        session = FakeSession(os.path.dirname(temp_tree))
+        target = str(tmp_path / "code.py")
+        
+        download_file(session, f"http://server/download?filename={basename(temp_tree)}/code.py", target, chunk_size=3)
+        
+        with open(target, "rb") as f:
+            assert f.read() == b"print(1)"
+        assert session.chunk_sizes == [3]
+        assert session.closed == 1
+    
+    def test_failed_download_leaves_nothing(self, temp_tree, tmp_path):
+        """Test that a failed request neither creates the file nor a temp file."""
+        name = f"{basename(temp_tree)}/code.py"
+        session = FakeSession(os.path.dirname(temp_tree), fail=[name])
+        
+        with pytest.raises(OSError):
+            download_file(session, f"http://server/download?filename={name}", str(tmp_path / "code.py"))
+        assert os.listdir(tmp_path) == []
+        assert session.closed == 1
+    
+    def test_install_with_fetcher(self, tmp_path):
+        """Test a full update streamed from /download urls, a failing file is retried."""
+        cur, new = version_pairs()[0]
+        device = str(tmp_path / "device")
+        shutil.copytree(os.path.join(FIRMWARE_FOLDER, cur), device)
+        new_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, new))
+        update_tree = new_tree - FolderEntry('.', root=device)
+        files = [e for e in walk(update_tree) if type(e) == FileEntry]
+        first = join_path(new, files[0].path)
+        session = FakeSession(FIRMWARE_FOLDER, fail=[first])
+        
+        install_tree(update_tree, Downloader(session, "http://server", new, chunk_size=512), root=device)
+        
+        assert session.urls[0] == f"http://server/download?filename={first}"
+        assert len(session.urls) == len(files) + 1
+        assert session.closed == len(session.urls)
+        assert set(session.chunk_sizes) == {512}
+        assert [e for e in walk(new_tree - FolderEntry('.', root=device)) if type(e) == FileEntry] == []
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves /download of the firmware folder over HTTP/1.1 keep-alive like the update server."""
+    
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        # stands in for the tls handshake of a new connection
+        time.sleep(self.server.handshake)
+    
+    def do_GET(self):
+        self.server.requests += 1
+        filename = parse_qs(urlparse(self.path).query)["filename"][0]
+        try:
+            with open(os.path.join(FIRMWARE_FOLDER, filename), "rb") as f:
+                content = f.read()
+        except OSError:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    
+    def log_message(self, *args):
+        pass
+
+
+class HttpxSession:
+    """The part of the adafruit_requests session api the updater uses, on top of httpx."""
+    
+    def __init__(self):
+        self.client = httpx.Client()
+    
+    def get(self, url, stream=False):
+        response = self.client.send(self.client.build_request("GET", url), stream=stream)
+        response.iter_content = response.iter_bytes
+        return response
+
+
+@pytest.fixture
+def stand_in_server():
+    """Run a local stand-in for the update server."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.connections = 0
+    server.requests = 0
+    server.handshake = 0.01
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestKeepAliveSession:
+    """Test cases for downloading a whole update over one connection."""
+    
+    @pytest.fixture
+    def update(self, tmp_path):
+        cur, new = version_pairs()[0]
+        device = str(tmp_path / "device")
+        shutil.copytree(os.path.join(FIRMWARE_FOLDER, cur), device)
+        update_tree = FolderEntry('.', root=os.path.join(FIRMWARE_FOLDER, new)) - FolderEntry('.', root=device)
+        return device, new, update_tree, [e for e in walk(update_tree) if type(e) == FileEntry]
+    
+    def test_one_connection(self, stand_in_server, update):
+        """Test that all files are downloaded over a single connection and timed."""
+        device, new, update_tree, files = update
+        server = f"http://127.0.0.1:{stand_in_server.server_port}"
+        downloader = Downloader(HttpxSession(), server, new)
+        
+        install_tree(update_tree, downloader, root=device)
+        
+        assert stand_in_server.connections == 1
+        assert stand_in_server.requests == len(files)
+        count, size, seconds = downloader.total()
+        assert count == len(files)
+        assert size == sum(os.path.getsize(os.path.join(FIRMWARE_FOLDER, new, e.path)) for e in files)
+        assert [t[0] for t in downloader.timings] == [e.path for e in files]
+        assert seconds > 0
+    
+    def test_round_trips(self, stand_in_server, update):
+        """Test that a session per file pays the handshake for every file."""
+        _, new, _, files = update
+        files = files[:10]
+        server = f"http://127.0.0.1:{stand_in_server.server_port}"
+        
+        start = time.monotonic()
+        for entry in files:
+            b"".join(Downloader(HttpxSession(), server, new)(entry))
+        fresh = time.monotonic() - start
+        assert stand_in_server.connections == len(files)
+        
+        stand_in_server.connections = 0
+        downloader = Downloader(HttpxSession(), server, new)
+        start = time.monotonic()
+        for entry in files:
+            b"".join(downloader(entry))
+        keep_alive = time.monotonic() - start
+        
+        assert stand_in_server.connections == 1
+        assert keep_alive < fresh
+
+
+class TestUnpackBundle:
+    """Test cases for writing a /bundle container to disk."""
+    
+    def bundle(self, files):
+        parts = []
+        for path, content, md5_checksum in files:
+            parts.append(f"{len(content)} {md5_checksum} {path}\n".encode() + content)
+        return b"".join(parts) + b"\n"
+    
+    def test_unpack_creates_folders(self, temp_tree):
+        """Test that files in new folders are written with their content."""
+        src = os.path.join(temp_tree, "code.py")
+        data = self.bundle([("./new/deep/code.py", b"print(1)", calculate_md5(src))])
+        
+        entries = unpack_bundle([data[i:i + 3] for i in range(0, len(data), 3)], root=temp_tree)
+        
+        assert [e.path for e in entries] == ["./new/deep/code.py"]
+        with open(os.path.join(temp_tree, "new", "deep", "code.py"), "rb") as f:
+            assert f.read() == b"print(1)"
+    
+    def test_unpack_checksum_mismatch(self, temp_tree):
+        """Test that a corrupted file is rejected and the old file is kept."""
+        data = self.bundle([("./code.py", b"print(2)", "0" * 32)])
+        
+        with pytest.raises(ValueError):
+            unpack_bundle([data], root=temp_tree)
+        with open(os.path.join(temp_tree, "code.py"), "rb") as f:
+            assert f.read() == b"print(1)"
+        assert not os.path.exists(os.path.join(temp_tree, "code.py.tmp"))
+    
+    def test_unpack_ignored(self, temp_tree):
+        """Test that ignored files are read past and kept while the files after them are written."""
+        data = self.bundle([
+            ("./code.py", b"print(2)", "0" * 32),
+            ("./ugm2/upgrade_mananger.py", b"new updater", "0" * 32),
+            ("./new.py", b"print(3)", hashlib.md5(b"new.py" + b"print(3)").hexdigest()),
+        ])
+        
+        entries = unpack_bundle([data[i:i + 5] for i in range(0, len(data), 5)], root=temp_tree,
+                                ignore={"./code.py", "./ugm2"})
+        
+        assert [e.path for e in entries] == ["./new.py"]
+        with open(os.path.join(temp_tree, "new.py"), "rb") as f:
+            assert f.read() == b"print(3)"
+        with open(os.path.join(temp_tree, "code.py"), "rb") as f:
+            assert f.read() == b"print(1)"
+        assert not os.path.exists(os.path.join(temp_tree, "ugm2"))
+    
+    def test_unpack_truncated(self, temp_tree):
+        """Test that a truncated container is rejected and leaves no partial file."""
+        data = self.bundle([("./code.py", b"print(2)", calculate_md5(os.path.join(temp_tree, "code.py")))])
+        
+        with pytest.raises(ValueError, match="truncated"):
+            unpack_bundle([data[:-4]], root=temp_tree)
+        with open(os.path.join(temp_tree, "code.py"), "rb") as f:
+            assert f.read() == b"print(1)"
+        assert not os.path.exists(os.path.join(temp_tree, "code.py.tmp"))
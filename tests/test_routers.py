@@ -1,4 +1,5 @@
 import pytest
+import asyncio
 import os
 import tempfile
 import shutil
@@ -13,14 +14,21 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
 
 from main import app
 from routers import router
-from dirTree import FolderEntry
+from dirTree import FolderEntry, FileEntry, walk, unpack_bundle
 from config import Config
+from utils import calculate_sha256, etag_matches, negotiate_encoding, read_ignore, IGNORE_FILE_PATH
+from versions import version_index
+from cache import manifest_cache, digest_cache, DigestCache, diff_cache, bundle_cache, LRUCache
+from workers import SingleFlight, WorkerPool, hash_pool
+from metrics import Histogram, metrics
+from files import OpenFileCache, OpenFileResponse, open_file_cache, SEND_CHUNK_SIZE
 
 
 @pytest.fixture
-def client():
-    """Create a test client for the FastAPI app."""
-    return TestClient(app)
+def reload_headers():
+    """Configure a reload token and return the headers that authorize /reload."""
+    with patch.object(Config, 'RELOAD_TOKEN', "test-token"):
+        yield {"X-Reload-Token": "test-token"}
 
 
 @pytest.fixture
@@ -127,6 +135,18 @@ class TestFileListEndpoint:
             # Should have at least 2 files
             assert len(data["childs"]) >= 2
     
+    def test_file_list_flat(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that ?flat=true returns the same tree as parallel arrays."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            nested = client.get(f"/file_list/{folder_name}")
+            flat = client.get(f"/file_list/{folder_name}?flat=true")
+            
+            assert flat.status_code == 200
+            assert FolderEntry.from_flat(flat.json()).to_dict() == nested.json()
+            assert flat.headers["etag"] != nested.headers["etag"]
+    
     def test_file_list_folder_not_found(self, client, temp_firmware_dir):
         """Test file list when folder doesn't exist."""
         with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
@@ -135,6 +155,16 @@ class TestFileListEndpoint:
             assert response.status_code == 404
             assert "Ordner nicht gefunden" in response.json()["detail"]
     
+    @pytest.mark.parametrize("folder", ["%2E%2E", "%2E", ".hidden"])
+    def test_file_list_outside_firmware_folder(self, client, temp_firmware_dir, folder):
+        """Test that names which leave the firmware folder or are hidden are not found."""
+        os.makedirs(os.path.join(temp_firmware_dir, ".hidden"))
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/file_list/{folder}")
+            
+            assert response.status_code == 404
+    
     def test_file_list_empty_folder(self, client, temp_firmware_dir):
         """Test file list for an empty folder."""
         folder_name = "empty_folder"
@@ -177,6 +207,931 @@ class TestFileListEndpoint:
             assert len(data["childs"]) >= 1
 
 
+class TestManifestCache:
+    """Test cases for the cached /file_list manifest."""
+    
+    def test_file_list_cache_hit(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that a second request is served from the cache."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            hits, misses = manifest_cache.hits, manifest_cache.misses
+            response1 = client.get(f"/file_list/{folder_name}")
+            response2 = client.get(f"/file_list/{folder_name}")
+            
+            assert response1.status_code == 200
+            assert response1.content == response2.content
+            assert manifest_cache.misses == misses + 1
+            assert manifest_cache.hits == hits + 1
+    
+    def test_file_list_cache_matches_folder_entry(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that the cached manifest equals a freshly built FolderEntry."""
+        folder_path, folder_name = sample_folder_structure
+        
+        cur_wd = os.getcwd()
+        os.chdir(folder_path)
+        expected = FolderEntry('.').to_dict()
+        os.chdir(cur_wd)
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get(f"/file_list/{folder_name}")
+            response = client.get(f"/file_list/{folder_name}")
+            
+            assert response.headers["content-type"] == "application/json"
+            assert response.json() == expected
+    
+    def test_file_list_cache_invalidated_on_change(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that adding a file to the folder invalidates the cached manifest."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response1 = client.get(f"/file_list/{folder_name}")
+            
+            with open(os.path.join(folder_path, "file3.txt"), "w") as f:
+                f.write("content3")
+            # make sure the mtime differs on filesystems with coarse timestamps
+            st = os.stat(folder_path)
+            os.utime(folder_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+            
+            response2 = client.get(f"/file_list/{folder_name}")
+            
+            assert len(response2.json()["childs"]) == len(response1.json()["childs"]) + 1
+            assert response2.json()["md5_checksum"] != response1.json()["md5_checksum"]
+    
+    def test_file_list_cache_invalidated_on_nested_change(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that a file rewritten in place in a subfolder invalidates the cached manifest after the recheck."""
+        folder_path, folder_name = sample_folder_structure
+        file_path = os.path.join(folder_path, "lib", "a.py")
+        os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "w") as f:
+            f.write("print(1)")
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response1 = client.get(f"/file_list/{folder_name}")
+            
+            # same size, neither the version folder nor lib change
+            with open(file_path, "w") as f:
+                f.write("print(2)")
+            st = os.stat(file_path)
+            os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+            
+            with patch.object(Config, 'MANIFEST_RECHECK_SECONDS', 3600):
+                assert client.get(f"/file_list/{folder_name}").content == response1.content
+            with patch.object(Config, 'MANIFEST_RECHECK_SECONDS', 0):
+                hits = manifest_cache.hits
+                response2 = client.get(f"/file_list/{folder_name}")
+                response3 = client.get(f"/file_list/{folder_name}")
+        
+        assert response2.json()["md5_checksum"] != response1.json()["md5_checksum"]
+        assert response3.content == response2.content
+        assert manifest_cache.hits == hits + 1
+    
+    def test_reload_clears_cache(self, client, reload_headers, temp_firmware_dir, sample_folder_structure):
+        """Test that /reload drops all cached manifests."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get(f"/file_list/{folder_name}")
+            
+            response = client.post("/reload", headers=reload_headers)
+            assert response.status_code == 200
+            assert response.json()["manifest"]["entries"] == 0
+            
+            misses = manifest_cache.misses
+            client.get(f"/file_list/{folder_name}")
+            assert manifest_cache.misses == misses + 1
+    
+    @pytest.mark.parametrize("token,headers", [
+        (None, {}),
+        (None, {"X-Reload-Token": ""}),
+        ("test-token", {}),
+        ("test-token", {"X-Reload-Token": "wrong-token"}),
+    ])
+    def test_reload_rejected(self, client, temp_firmware_dir, sample_folder_structure, token, headers):
+        """Test that /reload without a configured token or with a wrong one keeps the cache."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), patch.object(Config, 'RELOAD_TOKEN', token):
+            client.get(f"/file_list/{folder_name}")
+            
+            response = client.post("/reload", headers=headers)
+            assert response.status_code == 403
+            
+            misses = manifest_cache.misses
+            client.get(f"/file_list/{folder_name}")
+            assert manifest_cache.misses == misses
+    
+    def test_cache_stats(self, client):
+        """Test that hit/miss counters are exposed."""
+        response = client.get("/cache_stats")
+        
+        assert response.status_code == 200
+        stats = response.json()["manifest"]
+        assert "hits" in stats
+        assert "misses" in stats
+        assert "entries" in stats
+
+
+class TestWorkerPools:
+    """Test cases for offloading hashing and tree walks to worker pools."""
+    
+    @pytest.mark.parametrize("mode", ["inline", "thread", "process"])
+    def test_download_in_all_modes(self, client, temp_firmware_dir, sample_file, mode):
+        """Test that /download works in every execution mode."""
+        import hashlib
+        file_path, filename = sample_file
+        pool = WorkerPool('hash', 1, 4, mode)
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch('cache.hash_pool', pool):
+            response = client.get(f"/download?filename={filename}")
+        pool.shutdown()
+        
+        assert response.status_code == 200
+        assert response.headers["sha256_checksum"] == hashlib.sha256(b"test file content").hexdigest()
+    
+    @pytest.mark.parametrize("mode", ["inline", "thread", "process"])
+    def test_file_list_in_all_modes(self, client, temp_firmware_dir, sample_folder_structure, mode):
+        """Test that manifests are built identically in every execution mode."""
+        folder_path, folder_name = sample_folder_structure
+        pool = WorkerPool('manifest', 1, 4, mode)
+        manifest_cache.reload()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch('cache.manifest_pool', pool):
+            response = client.get(f"/file_list/{folder_name}")
+        pool.shutdown()
+        
+        assert response.status_code == 200
+        assert len(response.json()["childs"]) == 2
+    
+    def test_full_pool_returns_503(self, client, temp_firmware_dir, sample_file):
+        """Test that requests are rejected once the queue of a pool is full."""
+        file_path, filename = sample_file
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch.object(hash_pool, 'max_queue', 0):
+            response = client.get(f"/download?filename={filename}")
+            
+            assert response.status_code == 503
+            assert response.headers["retry-after"] == "1"
+        assert hash_pool.pending == 0
+    
+    def test_invalid_mode(self):
+        """Test that unknown execution modes are rejected."""
+        with pytest.raises(ValueError):
+            WorkerPool('hash', 1, 1, 'fiber')
+
+
+class TestSingleFlight:
+    """Test cases for coalescing concurrent identical computations."""
+    
+    async def test_coalesce(self):
+        """Test that concurrent calls with the same key share one computation."""
+        flight = SingleFlight()
+        calls = []
+        
+        async def build(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return [value]
+        
+        results = await asyncio.gather(*(flight.run("a", build, 1) for _ in range(10)), flight.run("b", build, 2))
+        
+        assert calls == [1, 2]
+        assert all(result is results[0] for result in results[:10])
+        assert results[10] == [2]
+        assert flight.coalesced == 9
+        # released once finished
+        await flight.run("a", build, 1)
+        assert calls == [1, 2, 1]
+    
+    async def test_exception_shared(self):
+        """Test that every waiter gets the exception and the next call computes again."""
+        flight = SingleFlight()
+        calls = []
+        
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise OSError("broken")
+        
+        results = await asyncio.gather(*(flight.run("a", fail) for _ in range(3)), return_exceptions=True)
+        
+        assert all(isinstance(result, OSError) for result in results)
+        assert len(calls) == 1
+        with pytest.raises(OSError):
+            await flight.run("a", fail)
+        assert len(calls) == 2
+    
+    async def test_cancelled_waiter(self):
+        """Test that a cancelled waiter does not cancel the computation of the others."""
+        flight = SingleFlight()
+        
+        async def build():
+            await asyncio.sleep(0.02)
+            return "done"
+        
+        first = asyncio.ensure_future(flight.run("a", build))
+        second = asyncio.ensure_future(flight.run("a", build))
+        await asyncio.sleep(0)
+        first.cancel()
+        
+        assert await second == "done"
+    
+    async def test_cold_manifest_built_once(self, temp_firmware_dir, sample_folder_structure):
+        """Test that concurrent requests for an uncached folder walk it only once."""
+        from utils import encode_manifest
+        folder_path, folder_name = sample_folder_structure
+        manifest_cache.reload()
+        
+        with patch('cache.encode_manifest', wraps=encode_manifest) as build:
+            results = await asyncio.gather(*(manifest_cache.get(folder_path) for _ in range(20)))
+        
+        assert build.call_count == 1
+        assert len(set(results)) == 1
+        assert manifest_cache.stats()["coalesced"] >= 19
+    
+    async def test_cold_digest_hashed_once(self, sample_file):
+        """Test that concurrent downloads of an unhashed file hash it only once."""
+        file_path, filename = sample_file
+        
+        with patch('cache.calculate_sha256', wraps=calculate_sha256) as sha256:
+            results = await asyncio.gather(*(digest_cache.get(file_path) for _ in range(20)))
+        
+        assert sha256.call_count == 1
+        assert len(set(results)) == 1
+
+
+class TestLRUCache:
+    """Test cases for the least recently used cache all caches share."""
+    
+    async def test_build_once(self):
+        """Test that a miss is built once and stored for the following lookups."""
+        cache = LRUCache(max_entries=2)
+        builds = []
+        
+        async def build(value):
+            builds.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+        
+        results = await asyncio.gather(*(cache._get("a", build, 1) for _ in range(5)))
+        
+        assert results == [2] * 5
+        assert builds == [1]
+        assert await cache._get("a", build, 1) == 2
+        assert cache.stats() == {"hits": 1, "misses": 5, "coalesced": 4, "entries": 1}
+    
+    def test_max_entries(self):
+        """Test that the least recently used entry is dropped first."""
+        cache = LRUCache(max_entries=2)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        cache.lookup("a")
+        cache.store("c", 3)
+        
+        assert list(cache._entries) == ["a", "c"]
+    
+    def test_max_bytes(self):
+        """Test that entries are dropped until their total size fits and replaced entries are not counted twice."""
+        cache = LRUCache(max_bytes=10)
+        cache.sizeof = len
+        cache.store("a", b"1234")
+        cache.store("a", b"123456")
+        cache.store("b", b"1234")
+        assert cache.stats()["bytes"] == 10
+        
+        cache.store("c", b"12")
+        
+        assert list(cache._entries) == ["b", "c"]
+        assert cache.stats()["bytes"] == 6
+
+
+class TestDigestCache:
+    """Test cases for the cached /download sha256 checksums."""
+    
+    def test_download_digest_cached(self, client, temp_firmware_dir, sample_file):
+        """Test that a file is hashed only once."""
+        file_path, filename = sample_file
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch('cache.calculate_sha256', wraps=calculate_sha256) as sha256:
+            response1 = client.get(f"/download?filename={filename}")
+            response2 = client.get(f"/download?filename={filename}")
+            
+            assert response1.headers["sha256_checksum"] == response2.headers["sha256_checksum"]
+            assert sha256.call_count == 1
+    
+    def test_download_digest_recomputed_on_change(self, client, temp_firmware_dir, sample_file):
+        """Test that a modified file gets a new checksum."""
+        import hashlib
+        file_path, filename = sample_file
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get(f"/download?filename={filename}")
+            with open(file_path, "wb") as f:
+                f.write(b"new content")
+            response = client.get(f"/download?filename={filename}")
+            
+            assert response.headers["sha256_checksum"] == hashlib.sha256(b"new content").hexdigest()
+    
+    def test_lru_eviction(self, temp_firmware_dir):
+        """Test that the least recently used digest is dropped."""
+        cache = DigestCache(max_entries=2)
+        cache.store(('a', 1, 1), 'da')
+        cache.store(('b', 1, 1), 'db')
+        assert cache.lookup(('a', 1, 1)) == 'da'
+        cache.store(('c', 1, 1), 'dc')
+        
+        assert cache.lookup(('b', 1, 1)) is None
+        assert cache.lookup(('a', 1, 1)) == 'da'
+        assert cache.lookup(('c', 1, 1)) == 'dc'
+    
+    def test_warm_up_and_sidecar(self, temp_firmware_dir, sample_folder_structure):
+        """Test that warm-up hashes every file and survives a restart via the sidecar file."""
+        folder_path, folder_name = sample_folder_structure
+        sidecar = os.path.join(temp_firmware_dir, "digests.json")
+        
+        cache = DigestCache(max_entries=100, path=sidecar)
+        assert cache.warm_up(temp_firmware_dir) == 2
+        assert cache.warm_up(temp_firmware_dir) == 0
+        cache.save()
+        
+        restored = DigestCache(max_entries=100, path=sidecar)
+        restored.load()
+        key = DigestCache.key(os.path.join(folder_path, "file1.txt"))
+        assert restored.lookup(key) == cache.lookup(key)
+    
+    def test_lifespan_warm_up(self, temp_firmware_dir, sample_folder_structure):
+        """Test that the firmware folder is hashed at startup."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch.object(Config, 'WARM_UP', True):
+            with TestClient(app):
+                key = DigestCache.key(os.path.join(folder_path, "file1.txt"))
+                assert digest_cache.lookup(key) is not None
+
+
+class TestLauncher:
+    """Test cases for the production entry point of main.py."""
+    
+    def test_run(self, temp_firmware_dir, sample_folder_structure, monkeypatch):
+        """Test that the digests are hashed before the workers start and the workers run without reload."""
+        import main
+        folder_path, folder_name = sample_folder_structure
+        monkeypatch.setenv("DIGEST_CACHE_FILE", "")
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir), \
+             patch.object(Config, 'WARM_UP', True), \
+             patch.object(Config, 'WEB_CONCURRENCY', 3), \
+             patch.object(digest_cache, 'path', None), \
+             patch('main.tempfile.gettempdir', return_value=temp_firmware_dir), \
+             patch('main.os.chdir'), \
+             patch('uvicorn.run') as run:
+            main.run()
+            
+            sidecar = os.path.join(temp_firmware_dir, "luftdaten-update-digests.json")
+            assert os.environ["DIGEST_CACHE_FILE"] == sidecar
+            restored = DigestCache(max_entries=100, path=sidecar)
+            restored.load()
+            assert restored.lookup(DigestCache.key(os.path.join(folder_path, "file1.txt"))) is not None
+        
+        args, kwargs = run.call_args
+        assert args == ("main:app",)
+        assert kwargs["workers"] == 3
+        assert "reload" not in kwargs
+
+
+class TestConditionalRequests:
+    """Test cases for ETag / If-None-Match handling."""
+    
+    def test_etag_matches(self):
+        """Test If-None-Match parsing."""
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('W/"abc"', '"abc"')
+        assert etag_matches('"x", "abc"', '"abc"')
+        assert etag_matches('*', '"abc"')
+        assert not etag_matches('"x"', '"abc"')
+        assert not etag_matches(None, '"abc"')
+    
+    def test_download_not_modified(self, client, temp_firmware_dir, sample_file):
+        """Test that /download answers a matching If-None-Match with an empty 304."""
+        import hashlib
+        file_path, filename = sample_file
+        etag = f'"{hashlib.sha256(b"test file content").hexdigest()}"'
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={filename}")
+            assert response.headers["etag"] == etag
+            
+            response = client.get(f"/download?filename={filename}", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+            
+            response = client.get(f"/download?filename={filename}", headers={"If-None-Match": '"other"'})
+            assert response.status_code == 200
+            assert response.content == b"test file content"
+    
+    def test_file_list_not_modified(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that /file_list uses the root md5_checksum as ETag."""
+        folder_path, folder_name = sample_folder_structure
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/file_list/{folder_name}")
+            etag = response.headers["etag"]
+            assert etag == f'"{response.json()["md5_checksum"]}"'
+            
+            response = client.get(f"/file_list/{folder_name}", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+    
+    def test_latest_version_not_modified(self, client, reload_headers, temp_firmware_dir):
+        """Test that /latest_version answers 304 until a new version is released."""
+        os.makedirs(os.path.join(temp_firmware_dir, "1_1_5_10"))
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/latest_version/1")
+            etag = response.headers["etag"]
+            
+            response = client.get("/latest_version/1", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+            
+            os.makedirs(os.path.join(temp_firmware_dir, "1_1_5_11"))
+            client.post("/reload", headers=reload_headers)
+            
+            response = client.get("/latest_version/1", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.json() == "1_1_5_11"
+
+
+class TestDiffEndpoint:
+    """Test cases for the /diff/{from_folder}/{to_folder} endpoint."""
+    
+    @pytest.fixture
+    def version_pair(self, temp_firmware_dir):
+        """Create two versions with an added, a changed, a removed and an unchanged file."""
+        for version, files in [
+            ("1_1_5_10", {"same.py": "same", "changed.py": "old", "removed.py": "gone"}),
+            ("1_1_5_11", {"same.py": "same", "changed.py": "new", "lib/added.py": "added"}),
+        ]:
+            for rel, content in files.items():
+                path = os.path.join(temp_firmware_dir, version, rel)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(content)
+        return "1_1_5_10", "1_1_5_11"
+    
+    def test_diff_success(self, client, temp_firmware_dir, version_pair):
+        """Test that only added, changed and removed files are returned."""
+        from_folder, to_folder = version_pair
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/diff/{from_folder}/{to_folder}")
+            
+            assert response.status_code == 200
+            data = response.json()
+            assert [e["path"] for e in data["added"]] == ["./lib/added.py"]
+            assert [e["path"] for e in data["changed"]] == ["./changed.py"]
+            assert [e["path"] for e in data["removed"]] == ["./removed.py"]
+            assert data["to_md5_checksum"] == client.get(f"/file_list/{to_folder}").json()["md5_checksum"]
+    
+    def test_diff_cached(self, client, temp_firmware_dir, version_pair):
+        """Test that a version pair is computed once and supports If-None-Match."""
+        from_folder, to_folder = version_pair
+        
+        diff_cache.reload()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            misses = diff_cache.misses
+            response1 = client.get(f"/diff/{from_folder}/{to_folder}")
+            response2 = client.get(f"/diff/{from_folder}/{to_folder}", headers={"If-None-Match": response1.headers["etag"]})
+            
+            assert diff_cache.misses == misses + 1
+            assert response2.status_code == 304
+    
+    def test_diff_folder_not_found(self, client, temp_firmware_dir, version_pair):
+        """Test diff when one of the folders doesn't exist."""
+        from_folder, to_folder = version_pair
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/diff/{from_folder}/nonexistent_folder")
+            
+            assert response.status_code == 404
+            assert "Ordner nicht gefunden" in response.json()["detail"]
+    
+    @pytest.mark.parametrize("from_folder,to_folder", [("1_1_5_10", "%2E%2E"), ("%2E%2E", "1_1_5_11")])
+    def test_diff_outside_firmware_folder(self, client, temp_firmware_dir, version_pair, from_folder, to_folder):
+        """Test that the folder above the firmware folder is neither hashed nor diffed."""
+        misses = diff_cache.misses
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/diff/{from_folder}/{to_folder}")
+        
+        assert response.status_code == 404
+        assert diff_cache.misses == misses
+    
+    def test_diff_matches_device_update_tree(self, client):
+        """Test that added + changed equals the files a device computes with new_tree - cur_tree."""
+        firmware = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+        from_folder, to_folder = "3_1_5_5", "3_1_6_0"
+        
+        # same steps as Ugm.install_update, the device keeps the paths of its ignore file
+        ignore = read_ignore(os.path.join(firmware, to_folder, IGNORE_FILE_PATH))
+        new_tree = FolderEntry('.', root=os.path.join(firmware, to_folder))
+        new_tree.drop(ignore)
+        update_tree = new_tree - FolderEntry('.', root=os.path.join(firmware, from_folder), ignore=ignore)
+        expected = {e.path: e.md5_checksum for e in walk(update_tree) if isinstance(e, FileEntry)}
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', firmware):
+            data = client.get(f"/diff/{from_folder}/{to_folder}").json()
+        
+        assert "./settings.toml" in ignore and "./ugm2" in ignore
+        assert {e["path"]: e["md5_checksum"] for e in data["added"] + data["changed"]} == expected
+    
+    def test_diff_ignored_files(self, client, temp_firmware_dir, version_pair):
+        """Test that the paths in the ignore file of the target version are not part of the diff."""
+        from_folder, to_folder = version_pair
+        for version, content in ((from_folder, "old"), (to_folder, "new")):
+            os.makedirs(os.path.join(temp_firmware_dir, version, "ugm2"))
+            for rel in ("settings.toml", "ugm2/upgrade_mananger.py"):
+                with open(os.path.join(temp_firmware_dir, version, rel), "w") as f:
+                    f.write(content)
+        with open(os.path.join(temp_firmware_dir, to_folder, IGNORE_FILE_PATH), "w") as f:
+            f.write("ugm2\nsettings.toml\nremoved.py\n")
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            data = client.get(f"/diff/{from_folder}/{to_folder}").json()
+        
+        assert [e["path"] for e in data["added"]] == ["./lib/added.py"]
+        assert [e["path"] for e in data["changed"]] == ["./changed.py"]
+        assert data["removed"] == []
+
+
+class TestBundleEndpoint:
+    """Test cases for the /bundle/{from_folder}/{to_folder} endpoint."""
+    
+    FIRMWARE = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+    
+    def test_bundle_upgrades_folder(self, client, temp_firmware_dir):
+        """Test that unpacking the bundle over the old version yields the new version and keeps the ignored files."""
+        from_folder, to_folder = "3_1_5_5", "3_1_6_0"
+        device = os.path.join(temp_firmware_dir, "device")
+        shutil.copytree(os.path.join(self.FIRMWARE, from_folder), device)
+        # a device in the field has its own config and the ignore list of its updater
+        with open(os.path.join(device, "settings.toml"), "w") as f:
+            f.write('SSID = "device"\n')
+        shutil.copyfile(os.path.join(self.FIRMWARE, to_folder, IGNORE_FILE_PATH), os.path.join(device, IGNORE_FILE_PATH))
+        # read like Ugm.install_update and bench_upgrade_storm.read_ignore
+        ignore = read_ignore(os.path.join(device, IGNORE_FILE_PATH))
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', self.FIRMWARE):
+            diff = client.get(f"/diff/{from_folder}/{to_folder}").json()
+            response = client.get(f"/bundle/{from_folder}/{to_folder}")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        
+        chunks = [response.content[i:i + 1024] for i in range(0, len(response.content), 1024)]
+        entries = unpack_bundle(chunks, root=device, ignore=ignore)
+        for entry in diff["removed"]:
+            os.remove(os.path.join(device, entry["path"]))
+        
+        new_tree = FolderEntry('.', root=os.path.join(self.FIRMWARE, to_folder))
+        new_tree.drop(ignore)
+        
+        assert "./settings.toml" in ignore and "./ugm2" in ignore
+        assert not [e for e in entries if e.path == "./settings.toml" or e.path.startswith("./ugm2/")]
+        assert len(entries) == len(diff["added"]) + len(diff["changed"])
+        assert FolderEntry('.', root=device, ignore=ignore).md5_checksum == new_tree.md5_checksum
+        with open(os.path.join(device, "settings.toml")) as f:
+            assert f.read() == 'SSID = "device"\n'
+        with open(os.path.join(device, "ugm2", "upgrade_mananger.py"), "rb") as f, \
+                open(os.path.join(self.FIRMWARE, from_folder, "ugm2", "upgrade_mananger.py"), "rb") as g:
+            assert f.read() == g.read()
+    
+    def test_bundle_cached(self, client, temp_firmware_dir):
+        """Test that the container of a version pair is built once."""
+        from cache import bundle_cache
+        bundle_cache.reload()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', self.FIRMWARE):
+            misses = bundle_cache.misses
+            response1 = client.get("/bundle/3_1_5_4/3_1_5_5")
+            response2 = client.get("/bundle/3_1_5_4/3_1_5_5", headers={"If-None-Match": response1.headers["etag"]})
+        
+        assert bundle_cache.misses == misses + 1
+        assert response2.status_code == 304
+    
+    def test_bundle_folder_not_found(self, client, temp_firmware_dir):
+        """Test bundle when one of the folders doesn't exist."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/bundle/1_1_5_10/1_1_5_11")
+            
+            assert response.status_code == 404
+
+    @pytest.mark.parametrize("from_folder,to_folder", [("3_1_6_0", "%2E%2E"), ("%2E%2E", "3_1_6_0")])
+    def test_bundle_outside_firmware_folder(self, client, from_folder, to_folder):
+        """Test that a bundle of the folder above the firmware folder is not built."""
+        bundles = bundle_cache.misses
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', self.FIRMWARE):
+            response = client.get(f"/bundle/{from_folder}/{to_folder}")
+        
+        assert response.status_code == 404
+        assert bundle_cache.misses == bundles
+
+
+class TestCompression:
+    """Test cases for pre-compressed /download variants."""
+    
+    CONTENT = b"import os\n" + b"print('luftdaten')\n" * 200
+    
+    @pytest.fixture
+    def text_file(self, temp_firmware_dir):
+        """Create a well compressible source file."""
+        with open(os.path.join(temp_firmware_dir, "main.py"), "wb") as f:
+            f.write(self.CONTENT)
+        return "main.py"
+    
+    def test_negotiate_encoding(self):
+        """Test Accept-Encoding parsing."""
+        available = ('gzip', 'deflate')
+        assert negotiate_encoding('gzip, deflate', available) == 'gzip'
+        assert negotiate_encoding('deflate', available) == 'deflate'
+        assert negotiate_encoding('gzip;q=0.5, deflate', available) == 'deflate'
+        assert negotiate_encoding('gzip;q=0', available) is None
+        assert negotiate_encoding('*', available) == 'gzip'
+        assert negotiate_encoding('br', available) is None
+        assert negotiate_encoding(None, available) is None
+        assert negotiate_encoding('gzip', ('deflate',)) is None
+    
+    @pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+    def test_download_compressed(self, client, temp_firmware_dir, text_file, encoding):
+        """Test that text files are sent compressed with the checksum of the uncompressed file."""
+        import hashlib
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={text_file}", headers={"Accept-Encoding": encoding})
+            
+            assert response.status_code == 200
+            assert response.headers["content-encoding"] == encoding
+            assert int(response.headers["content-length"]) < len(self.CONTENT)
+            assert response.content == self.CONTENT
+            assert response.headers["sha256_checksum"] == hashlib.sha256(self.CONTENT).hexdigest()
+            assert "Accept-Encoding" in response.headers["vary"]
+    
+    def test_download_deflate_small_window(self, client, temp_firmware_dir, text_file):
+        """Test that the deflate variant can be decoded with a small window."""
+        import zlib
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            with client.stream("GET", f"/download?filename={text_file}", headers={"Accept-Encoding": "deflate"}) as response:
+                raw = b"".join(response.iter_raw())
+        
+        assert zlib.decompress(raw, 10) == self.CONTENT
+    
+    def test_download_identity(self, client, temp_firmware_dir, text_file):
+        """Test that clients without Accept-Encoding get the file as is."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={text_file}", headers={"Accept-Encoding": "identity"})
+            
+            assert "content-encoding" not in response.headers
+            assert response.content == self.CONTENT
+    
+    def test_download_binary_not_compressed(self, client, temp_firmware_dir, sample_file):
+        """Test that binary files are never compressed."""
+        file_path, filename = sample_file
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={filename}", headers={"Accept-Encoding": "gzip"})
+            
+            assert "content-encoding" not in response.headers
+    
+    def test_download_compressed_not_modified(self, client, temp_firmware_dir, text_file):
+        """Test that each variant has its own ETag."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            gzip_etag = client.get(f"/download?filename={text_file}", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+            identity_etag = client.get(f"/download?filename={text_file}", headers={"Accept-Encoding": "identity"}).headers["etag"]
+            assert gzip_etag != identity_etag
+            
+            response = client.get(f"/download?filename={text_file}",
+                                  headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_etag})
+            assert response.status_code == 304
+
+
+class TestRangeRequests:
+    """Test cases for partial /download requests."""
+    
+    CONTENT = bytes(range(256)) * 40
+    
+    @pytest.fixture
+    def large_file(self, temp_firmware_dir):
+        """Create a binary file and a compressible file."""
+        with open(os.path.join(temp_firmware_dir, "lib.mpy"), "wb") as f:
+            f.write(self.CONTENT)
+        with open(os.path.join(temp_firmware_dir, "code.py"), "wb") as f:
+            f.write(b"print('luftdaten')\n" * 200)
+        return "lib.mpy"
+    
+    def test_accept_ranges(self, client, temp_firmware_dir, large_file):
+        """Test that full downloads advertise range support."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={large_file}")
+            
+            assert response.status_code == 200
+            assert response.headers["accept-ranges"] == "bytes"
+    
+    @pytest.mark.parametrize("range_header,start,end", [
+        ("bytes=0-99", 0, 100),
+        ("bytes=1000-", 1000, 10240),
+        ("bytes=-240", 10000, 10240),
+        ("bytes=10000-99999", 10000, 10240),
+    ])
+    def test_single_range(self, client, temp_firmware_dir, large_file, range_header, start, end):
+        """Test that a single range is answered with 206 and the checksum of the full file."""
+        import hashlib
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={large_file}", headers={"Range": range_header})
+            
+            assert response.status_code == 206
+            assert response.content == self.CONTENT[start:end]
+            assert response.headers["content-range"] == f"bytes {start}-{end - 1}/{len(self.CONTENT)}"
+            assert response.headers["content-length"] == str(end - start)
+            assert response.headers["sha256_checksum"] == hashlib.sha256(self.CONTENT).hexdigest()
+            assert response.headers["etag"] == f'"{hashlib.sha256(self.CONTENT).hexdigest()}"'
+    
+    def test_range_not_satisfiable(self, client, temp_firmware_dir, large_file):
+        """Test that a range behind the end of the file is answered with 416."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get(f"/download?filename={large_file}", headers={"Range": "bytes=10240-"})
+            
+            assert response.status_code == 416
+            assert response.headers["content-range"] == f"bytes */{len(self.CONTENT)}"
+    
+    def test_resume(self, client, temp_firmware_dir, large_file):
+        """Test that an interrupted download can be completed with a range request."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            first = client.get(f"/download?filename={large_file}")
+            partial = first.content[:4000]
+            
+            rest = client.get(f"/download?filename={large_file}",
+                              headers={"Range": f"bytes={len(partial)}-", "If-Range": first.headers["etag"]})
+            
+            assert rest.status_code == 206
+            assert partial + rest.content == self.CONTENT
+    
+    def test_if_range_changed_file(self, client, temp_firmware_dir, large_file):
+        """Test that a resume against a changed file gets the whole new file."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            etag = client.get(f"/download?filename={large_file}").headers["etag"]
+            with open(os.path.join(temp_firmware_dir, large_file), "wb") as f:
+                f.write(b"new content")
+            
+            response = client.get(f"/download?filename={large_file}",
+                                  headers={"Range": "bytes=5-", "If-Range": etag})
+            
+            assert response.status_code == 200
+            assert response.content == b"new content"
+    
+    def test_range_not_compressed(self, client, temp_firmware_dir, large_file):
+        """Test that ranges of compressible files refer to the uncompressed file."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/download?filename=code.py",
+                                  headers={"Range": "bytes=0-4", "Accept-Encoding": "gzip"})
+            
+            assert response.status_code == 206
+            assert "content-encoding" not in response.headers
+            assert response.content == b"print"
+    
+    def test_if_range_compressed_etag(self, client, temp_firmware_dir, large_file):
+        """Test that resuming a compressed transfer restarts with the whole uncompressed file."""
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            etag = client.get("/download?filename=code.py", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+            
+            response = client.get("/download?filename=code.py",
+                                  headers={"Range": "bytes=5-", "If-Range": etag, "Accept-Encoding": "gzip"})
+            
+            assert response.status_code == 200
+            assert response.content == b"print('luftdaten')\n" * 200
+
+
+class TestOpenFileCache:
+    """Test cases for serving /download from cached file descriptors."""
+    
+    def test_headers_like_file_response(self, client, temp_firmware_dir, sample_file):
+        """Test that the fast path sends the same headers as FileResponse."""
+        file_path, filename = sample_file
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            mapped = client.get(f"/download?filename={filename}")
+            ranged = client.get(f"/download?filename={filename}", headers={"Range": "bytes=0-"})
+        
+        assert mapped.status_code == 200
+        assert mapped.content == b"test file content"
+        for header in ("content-length", "content-type", "content-disposition", "last-modified", "accept-ranges",
+                       "etag", "sha256_checksum"):
+            assert mapped.headers[header] == ranged.headers[header]
+    
+    def test_cached_and_reopened(self, client, temp_firmware_dir, sample_file):
+        """Test that a file is opened once and again after it changed."""
+        file_path, filename = sample_file
+        open_file_cache.reload()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            misses = open_file_cache.misses
+            client.get(f"/download?filename={filename}")
+            client.get(f"/download?filename={filename}")
+            assert open_file_cache.misses == misses + 1
+            
+            with open(file_path, "wb") as f:
+                f.write(b"replaced content")
+            response = client.get(f"/download?filename={filename}")
+        
+        assert response.content == b"replaced content"
+        assert open_file_cache.misses == misses + 2
+    
+    def test_eviction(self, temp_firmware_dir):
+        """Test that at most max_files are kept and evicted files stay readable."""
+        cache = OpenFileCache(max_files=2)
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(temp_firmware_dir, f"{i}.mpy"))
+            with open(paths[-1], "wb") as f:
+                f.write(bytes([i]) * 10)
+        
+        first = cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[2])
+        
+        assert cache.stats()["entries"] == 2
+        assert first.read(0, 10) == bytes([0]) * 10
+        assert cache.get(os.path.join(temp_firmware_dir, "missing.mpy")) is None
+        assert cache.get(temp_firmware_dir) is None
+    
+    @pytest.mark.parametrize("filename", ["/etc/hostname", "../../../../etc/hostname", "%2E%2E/outside.txt", "link/outside.txt"])
+    def test_download_outside_firmware_folder(self, client, temp_firmware_dir, filename):
+        """Test that files outside the firmware folder are neither opened nor sent."""
+        firmware = os.path.join(temp_firmware_dir, "firmware")
+        os.makedirs(firmware)
+        with open(os.path.join(temp_firmware_dir, "outside.txt"), "w") as f:
+            f.write("secret")
+        os.symlink(temp_firmware_dir, os.path.join(firmware, "link"))
+        misses = open_file_cache.misses
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', firmware):
+            response = client.get(f"/download?filename={filename}")
+        
+        assert response.status_code == 404
+        assert open_file_cache.misses == misses
+    
+    async def test_truncated_while_sent(self, temp_firmware_dir):
+        """Test that a file truncated after its headers were built fails the response."""
+        file_path = os.path.join(temp_firmware_dir, "blob.bin")
+        with open(file_path, "wb") as f:
+            f.write(os.urandom(2 * SEND_CHUNK_SIZE))
+        response = OpenFileResponse(OpenFileCache(max_files=1).get(file_path), "blob.bin")
+        messages = []
+        
+        async def send(message):
+            messages.append(message)
+            if len(messages) == 2:
+                os.truncate(file_path, 10)
+        
+        with pytest.raises(OSError, match="truncated"):
+            await response({"type": "http", "method": "GET"}, None, send)
+        
+        assert [len(message.get("body", b"")) for message in messages] == [0, SEND_CHUNK_SIZE]
+        assert messages[-1]["more_body"]
+    
+    @pytest.mark.parametrize("size", [0, SEND_CHUNK_SIZE, 2 * SEND_CHUNK_SIZE + 5])
+    def test_sizes(self, client, temp_firmware_dir, size):
+        """Test empty files and files sent in several parts."""
+        content = os.urandom(size)
+        with open(os.path.join(temp_firmware_dir, "blob.bin"), "wb") as f:
+            f.write(content)
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/download?filename=blob.bin")
+        
+        assert response.status_code == 200
+        assert response.content == content
+        assert response.headers["content-length"] == str(size)
+    
+    def test_non_ascii_filename(self, client, temp_firmware_dir):
+        """Test the content disposition of names that have to be quoted."""
+        with open(os.path.join(temp_firmware_dir, "größe.py"), "wb") as f:
+            f.write(b"x")
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/download?filename=größe.py", headers={"Accept-Encoding": "identity"})
+        
+        assert response.headers["content-disposition"] == "attachment; filename*=utf-8''gr%C3%B6%C3%9Fe.py"
+
+
 class TestLatestVersionEndpoint:
     """Test cases for the /latest_version/{model_id} endpoint."""
     
@@ -274,4 +1229,143 @@ class TestLatestVersionEndpoint:
             # Should return 1_1_5_10 (not 1_1_5_3 lexicographically)
             # FastAPI JSON-encodes string responses, so use json() instead of text
             assert response.json() == "1_1_5_10"
+    
+    def test_latest_version_ignores_stray_entries(self, client, temp_firmware_dir):
+        """Test that entries which are not version folders are skipped."""
+        for name in ["1_1_5_10", "1_beta", "1_1_5_x", ".git"]:
+            os.makedirs(os.path.join(temp_firmware_dir, name), exist_ok=True)
+        with open(os.path.join(temp_firmware_dir, "1_1_5_99"), "w") as f:
+            f.write("not a folder")
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            response = client.get("/latest_version/1")
+            
+            assert response.status_code == 200
+            assert response.json() == "1_1_5_10"
+    
+    def test_latest_version_picks_up_new_release(self, client, temp_firmware_dir):
+        """Test that the index is rebuilt when a version folder is added."""
+        os.makedirs(os.path.join(temp_firmware_dir, "1_1_5_10"), exist_ok=True)
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            assert client.get("/latest_version/1").json() == "1_1_5_10"
+            generation = version_index.generation
+            assert client.get("/latest_version/1").json() == "1_1_5_10"
+            assert version_index.generation == generation
+            
+            os.makedirs(os.path.join(temp_firmware_dir, "1_1_5_11"))
+            # make sure the mtime differs on filesystems with coarse timestamps
+            st = os.stat(temp_firmware_dir)
+            os.utime(temp_firmware_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+            
+            assert client.get("/latest_version/1").json() == "1_1_5_11"
+    
+    def test_latest_version_reload(self, client, reload_headers, temp_firmware_dir):
+        """Test that /reload forces a rebuild of the index."""
+        os.makedirs(os.path.join(temp_firmware_dir, "1_1_5_10"), exist_ok=True)
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get("/latest_version/1")
+            generation = version_index.generation
+            client.post("/reload", headers=reload_headers)
+            client.get("/latest_version/1")
+            
+            assert version_index.generation == generation + 1
+
+
+class TestMetrics:
+    """Test cases for the /metrics endpoint."""
+    
+    @staticmethod
+    def samples(text):
+        """Parse the prometheus text format into name{labels} -> value."""
+        return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+                for line in text.splitlines() if line and not line.startswith("#")}
+    
+    def test_histogram(self):
+        """Test that bucket counts are cumulative and values on a bound fall into that bucket."""
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        
+        assert histogram.render("x", 'route="/"') == [
+            'x_bucket{route="/",le="0.1"} 2',
+            'x_bucket{route="/",le="1.0"} 3',
+            'x_bucket{route="/",le="+Inf"} 4',
+            'x_sum{route="/"} 2.65',
+            'x_count{route="/"} 4',
+        ]
+    
+    def test_requests_per_route(self, client, temp_firmware_dir, sample_file):
+        """Test that requests, latency and bytes are counted per route template."""
+        file_path, filename = sample_file
+        metrics.reset()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get(f"/download?filename={filename}")
+            client.get(f"/download?filename={filename}")
+            client.get("/download?filename=missing.bin")
+            client.get("/unknown")
+            samples = self.samples(client.get("/metrics").text)
+        
+        assert samples['update_requests_total{route="/download",status="200"}'] == 2
+        assert samples['update_requests_total{route="/download",status="404"}'] == 1
+        assert samples['update_requests_total{route="other",status="404"}'] == 1
+        assert samples['update_request_duration_seconds_count{route="/download"}'] == 3
+        assert samples['update_request_duration_seconds_bucket{route="/download",le="+Inf"}'] == 3
+        assert samples['update_response_bytes_total{route="/download"}'] >= 2 * len(b"test file content")
+    
+    def test_versions_and_hashing(self, client, temp_firmware_dir, sample_folder_structure):
+        """Test that requested versions are counted per model and hashing time is recorded."""
+        folder_path, folder_name = sample_folder_structure
+        metrics.reset()
+        manifest_cache.reload()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            client.get(f"/file_list/{folder_name}")
+            client.get(f"/file_list/{folder_name}")
+            client.get("/file_list/1_9_9_9")
+            client.get(f"/download?filename={folder_name}/file1.txt")
+            samples = self.samples(client.get("/metrics").text)
+        
+        assert samples[f'update_version_requests_total{{model="1",version="{folder_name}"}}'] == 2
+        assert 'update_version_requests_total{model="1",version="1_9_9_9"}' not in samples
+        assert samples['update_request_duration_seconds_count{route="/file_list/{folder}"}'] == 3
+        assert samples['update_hash_total{algorithm="md5"}'] == 1
+        assert samples['update_hash_seconds_total{algorithm="md5"}'] > 0
+        assert samples['update_cache_misses{cache="manifest"}'] >= 1
+    
+    def test_versions_diff_and_bundle(self, client):
+        """Test that /diff and /bundle count their target version."""
+        firmware = os.path.join(os.path.dirname(__file__), '..', 'app', 'firmware')
+        metrics.reset()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', firmware):
+            client.get("/diff/3_1_5_4/3_1_5_5")
+            client.get("/bundle/3_1_5_4/3_1_5_5")
+            client.get("/diff/3_1_5_4/3_9_9_9")
+            samples = self.samples(client.get("/metrics").text)
+        
+        assert samples['update_version_requests_total{model="3",version="3_1_5_5"}'] == 2
+        assert 'update_version_requests_total{model="3",version="3_1_5_4"}' not in samples
+        assert 'update_version_requests_total{model="3",version="3_9_9_9"}' not in samples
+    
+    def test_versions_only_version_names(self, client, temp_firmware_dir):
+        """Test that only folder names of firmware versions are counted as versions."""
+        os.makedirs(os.path.join(temp_firmware_dir, "nested_folder"))
+        metrics.reset()
+        
+        with patch.object(Config, 'FIRMWARE_FOLDER', temp_firmware_dir):
+            assert client.get("/file_list/nested_folder").status_code == 200
+            assert client.get("/file_list/%2E%2E").status_code == 404
+            samples = self.samples(client.get("/metrics").text)
+        
+        assert not [name for name in samples if name.startswith("update_version_requests_total")]
+    
+    def test_content_type(self, client):
+        """Test the content type of the prometheus text format."""
+        response = client.get("/metrics")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
 